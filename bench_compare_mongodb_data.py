@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import pymongo
+import bson
+import time
+import sys
+import getopt
+import os
+import json
+import random
+import shutil
+import tempfile
+import subprocess
+import tracemalloc
+import uuid
+from bson.objectid import ObjectId
+
+import compare_mongodb_data as compare
+
+'''
+compare_mongodb_data.py的性能基准测试: 在两个本地mongod上按配置生成测试数据(行数、文档结构、_id类型、注入的差异比例)，
+对每个集合依次跑各个--comparison-mode以及sample模式下按版本区分的取样分支($sample / 沿_id索引定位 / skip)，
+记录每秒对比行数、两端往返次数、内存峰值和耗时，可以保存为基线，之后的运行和基线对比，发现data_comparison的性能回退
+
+两个mongod可以用--src/--dest指定已有的实例，也可以用--mongod指定mongod可执行文件，由脚本在临时目录启动两个实例，结束后清理
+'''
+
+BENCH_DB = 'compare_bench'
+# 基准测试的运行方式: 名字 -> (comparison-mode, sample-version)，sample-version为0时用$sample，很大时走低版本的取样分支
+RUNS = {'no': ('no', 40), 'sample': ('sample', 0), 'sample-legacy': ('sample', 9999), 'all': ('all', 40), 'hash': ('hash', 40)}
+DEFAULT_DATASET = 'flat_oid:100000:flat:objectid:0.001,nested_int:50000:nested:int:0.001,large_str:10000:large:string:0.001'
+SHAPES = ('flat', 'nested', 'large')
+ID_TYPES = ('objectid', 'int', 'string', 'uuid', 'mixed')
+configure = dict()
+
+
+def log_info(message):
+    print("INFO  [%s] %s " % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+
+
+def log_error(message):
+    print("ERROR [%s] %s " % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+
+
+def parse_dataset(spec):
+    '''
+    解析--dataset: 逗号分隔的 集合名:行数:文档结构:_id类型:差异比例
+    :return: list dict
+    '''
+    colls = []
+    for item in spec.split(','):
+        name, docs, shape, id_type, diff_rate = item.split(':')
+        if shape not in SHAPES or id_type not in ID_TYPES:
+            log_error("dataset[%s] illegal, shape in %s, _id type in %s" % (item, SHAPES, ID_TYPES))
+            sys.exit(1)
+        colls.append({'name': name, 'docs': int(docs), 'shape': shape, 'id_type': id_type, 'diff_rate': float(diff_rate)})
+    return colls
+
+
+def make_id(id_type, i, rnd):
+    if id_type == 'objectid':
+        return ObjectId()
+    if id_type == 'int':
+        return i
+    if id_type == 'string':
+        return 'key-%012d' % i
+    if id_type == 'uuid':
+        return bson.Binary.from_uuid(uuid.UUID(int=rnd.getrandbits(128)))
+    # mixed: 几种类型轮流出现，走type-bracketing和合并排序的路径
+    return (i, 'key-%012d' % i, ObjectId(), float(i) + 0.5)[i % 4]
+
+
+def make_doc(shape, _id, i, rnd):
+    doc = {'_id': _id, 'seq': i, 'name': 'user-%d' % i, 'score': rnd.random(), 'active': i % 2 == 0}
+    if shape == 'nested':
+        doc['profile'] = {'age': rnd.randint(18, 80), 'tags': ['t%d' % rnd.randint(0, 50) for _ in range(5)],
+                          'address': {'city': 'city-%d' % rnd.randint(0, 1000), 'zip': '%06d' % rnd.randint(0, 999999)}}
+        doc['events'] = [{'type': 'e%d' % j, 'at': i + j} for j in range(rnd.randint(1, 8))]
+    elif shape == 'large':
+        doc['payload'] = os.urandom(16 * 1024)
+    return doc
+
+
+def seed(src, dst, spec):
+    '''
+    两端写入同样的数据，再在目标端按差异比例注入修改、删除和多出的文档
+    :return: 注入的差异数
+    '''
+    rnd = random.Random(spec['name'])
+    srcColl, dstColl = src[BENCH_DB][spec['name']], dst[BENCH_DB][spec['name']]
+    srcColl.drop()
+    dstColl.drop()
+    batch, ids = [], []
+    for i in range(spec['docs']):
+        batch.append(make_doc(spec['shape'], make_id(spec['id_type'], i, rnd), i, rnd))
+        if len(batch) >= 1000:
+            srcColl.insert_many(batch, ordered=False)
+            dstColl.insert_many(batch, ordered=False)
+            ids.extend(doc['_id'] for doc in batch)
+            batch = []
+    if batch:
+        srcColl.insert_many(batch, ordered=False)
+        dstColl.insert_many(batch, ordered=False)
+        ids.extend(doc['_id'] for doc in batch)
+
+    diffs = int(spec['docs'] * spec['diff_rate'])
+    for n, _id in enumerate(rnd.sample(ids, min(diffs, len(ids)))):
+        if n % 3 == 0:
+            dstColl.update_one({'_id': _id}, {'$set': {'score': -1}})
+        elif n % 3 == 1:
+            dstColl.delete_one({'_id': _id})
+        else:
+            dstColl.insert_one(make_doc(spec['shape'], make_id(spec['id_type'], spec['docs'] + n, rnd), spec['docs'] + n, rnd))
+    log_info("seed [%s.%s] %d docs, shape %s, _id %s, %d diffs" % (BENCH_DB, spec['name'], spec['docs'], spec['shape'], spec['id_type'], diffs))
+    return diffs
+
+
+def compare_argv(mode, sample_version):
+    # 每次运行用compare_mongodb_data自己的参数解析生成配置，和命令行运行时的默认值一致
+    argv = ['compare_mongodb_data.py', '--src=' + configure['src'], '--dest=' + configure['dest'], '--comparison-mode=' + mode,
+            '--sample-version=%d' % sample_version, '--count=%d' % configure['count'], '--continue=True']
+    return argv + configure['extra']
+
+
+def run_once(sc, dc, spec, name, trace=False):
+    '''
+    对一个集合跑一次对比，每次运行用新的Comparator，统计和元数据缓存互不影响，连接用外面建好的
+    :param trace: 用tracemalloc记录本次运行的内存峰值，跟踪分配会拖慢对比，这次的每秒行数不能当作性能指标
+    :return: dict 本次运行的指标
+    '''
+    mode, sample_version = RUNS[name]
+    sys.argv = compare_argv(mode, sample_version)
+    comparator = compare.Comparator(*compare.parse_args())
+    token = compare.COMPARATOR.set(comparator)
+    try:
+        qtname = '%s.%s' % (BENCH_DB, spec['name'])
+        srcColl, dstColl = sc[BENCH_DB][spec['name']], dc[BENCH_DB][spec['name']]
+
+        if trace:
+            tracemalloc.start()
+        start = time.time()
+        status, checked, _ = compare.data_comparison(srcColl, dstColl, mode, comparator.configure[compare.LATEST_SIZE],
+                                                     comparator.configure[compare.FULL_CHECK_SIZE], comparator.configure[compare.CHECK_PERC], qtname)
+        wall = time.time() - start
+        # 每次运行重新开始跟踪，峰值只反映本次运行在当前进程中的分配，不含进程池worker
+        peak = tracemalloc.get_traced_memory()[1] if trace else 0
+        info = comparator.configure['compare_info'].get(qtname)
+        metrics = comparator.metrics.report()['namespaces'].get(qtname, {})
+        # data_comparison的返回值在某些分支不是检查行数，以compare_info为准
+        checked = info[2] if info else checked
+        return {'coll': spec['name'], 'run': name, 'status': bool(status), 'checked': checked, 'wall': wall,
+                'docs_per_sec': checked / wall if wall > 0 else 0,
+                'src_roundtrips': metrics.get('src', {}).get('requests', 0), 'dst_roundtrips': metrics.get('dst', {}).get('requests', 0),
+                'src_bytes': metrics.get('src_bytes', 0), 'dst_bytes': metrics.get('dst_bytes', 0), 'peak_mem_kb': peak // 1024}
+    finally:
+        if trace:
+            tracemalloc.stop()
+        compare.COMPARATOR.reset(token)
+
+
+def check_baseline(results, baseline, tolerance):
+    '''
+    和基线对比每秒对比行数，下降超过tolerance的算回退
+    :return: 回退的运行列表
+    '''
+    regressions = []
+    for result in results:
+        key = '%s/%s' % (result['coll'], result['run'])
+        base = baseline.get(key)
+        if base is None or base['docs_per_sec'] <= 0:
+            continue
+        change = result['docs_per_sec'] / base['docs_per_sec'] - 1
+        if change < -tolerance:
+            log_error("REGRESSION => [%s] %.0f docs/s, baseline %.0f docs/s (%.1f%%)" % (key, result['docs_per_sec'], base['docs_per_sec'], change * 100))
+            regressions.append(key)
+        else:
+            log_info("baseline [%s] %.0f docs/s, baseline %.0f docs/s (%+.1f%%)" % (key, result['docs_per_sec'], base['docs_per_sec'], change * 100))
+    return regressions
+
+
+class LocalMongod(object):
+    # 在临时目录启动的mongod实例，--mongod指定时使用
+    def __init__(self, binary, port):
+        self.port = port
+        self.dbpath = tempfile.mkdtemp(prefix='compare_bench_')
+        self.process = subprocess.Popen([binary, '--dbpath', self.dbpath, '--port', str(port), '--bind_ip', '127.0.0.1', '--quiet'],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.url = 'mongodb://127.0.0.1:%d/' % port
+        deadline = time.time() + 30
+        while True:
+            try:
+                pymongo.MongoClient(self.url, serverSelectionTimeoutMS=500).admin.command('ping')
+                break
+            except pymongo.errors.PyMongoError:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError("mongod on port %d failed to start" % port)
+                time.sleep(0.5)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.dbpath, ignore_errors=True)
+
+
+def usage():
+    print(
+        """Usage:
+./bench_compare_mongodb_data.py   \\
+--src=mongodb://127.0.0.1:27017/ --dest=mongodb://127.0.0.1:27018/ (两个本地mongod，会删除并重建其中的compare_bench库) \\
+--mongod=/usr/bin/mongod (指定时在临时目录启动两个mongod，端口为--port和--port+1，忽略--src/--dest) \\
+--port=27117  \\
+--dataset='flat_oid:100000:flat:objectid:0.001,...' (集合名:行数:文档结构(flat/nested/large):_id类型(objectid/int/string/uuid/mixed):差异比例) \\
+--runs=no,sample,sample-legacy,all,hash (要跑的对比方式，sample-legacy为低版本取样分支: 数字类_id沿索引定位，其余类型用skip) \\
+--repeat=1 (每种对比方式重复次数，取每秒行数最高的一次) \\
+--seed=True (是否重新生成数据，False时沿用上次生成的数据) \\
+--count=10000 (sample模式的对比行数) \\
+--compare-args='--cursor-batch=1000 --raw-bson=True' (原样传给compare_mongodb_data的其他参数) \\
+--save-baseline=bench.json (保存本次结果为基线) \\
+--baseline=bench.json --tolerance=0.2 (和基线对比，每秒对比行数下降超过20%时退出码为1)""")
+
+
+def parse_args():
+    opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "src=", "dest=", "mongod=", "port=", "dataset=", "runs=", "repeat=", "seed=",
+                                                   "count=", "compare-args=", "save-baseline=", "baseline=", "tolerance="])
+    configure['src'], configure['dest'] = 'mongodb://127.0.0.1:27017/', 'mongodb://127.0.0.1:27018/'
+    configure['mongod'], configure['port'] = '', 27117
+    configure['dataset'] = parse_dataset(DEFAULT_DATASET)
+    configure['runs'] = ['no', 'sample', 'sample-legacy', 'all', 'hash']
+    configure['repeat'], configure['seed'], configure['count'] = 1, True, 10000
+    configure['extra'] = []
+    configure['save_baseline'], configure['baseline'], configure['tolerance'] = '', '', 0.2
+    for key, value in opts:
+        if key in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if key == '--src':
+            configure['src'] = value
+        if key == '--dest':
+            configure['dest'] = value
+        if key == '--mongod':
+            configure['mongod'] = value
+        if key == '--port':
+            configure['port'] = int(value)
+        if key == '--dataset':
+            configure['dataset'] = parse_dataset(value)
+        if key == '--runs':
+            configure['runs'] = value.split(',')
+            for name in configure['runs']:
+                if name not in RUNS:
+                    log_error("run[%s] illegal, should be in %s" % (name, sorted(RUNS)))
+                    sys.exit(1)
+        if key == '--repeat':
+            configure['repeat'] = max(int(value), 1)
+        if key == '--seed':
+            configure['seed'] = str(value).lower() == 'true'
+        if key == '--count':
+            configure['count'] = int(value)
+        if key == '--compare-args':
+            configure['extra'] = value.split()
+        if key == '--save-baseline':
+            configure['save_baseline'] = value
+        if key == '--baseline':
+            configure['baseline'] = value
+        if key == '--tolerance':
+            configure['tolerance'] = float(value)
+
+
+if __name__ == "__main__":
+    parse_args()
+    # 和compare_mongodb_data的入口一样按参数创建进程池和范围线程池，所有运行共用，进程池要在创建线程之前fork
+    sys.argv = compare_argv('all', 40)
+    options = compare.parse_args()[2]
+    compare.create_pools(options[compare.PROCESSES], options[compare.RANGE_THREADS])
+    mongods = []
+    if configure['mongod']:
+        mongods = [LocalMongod(configure['mongod'], configure['port']), LocalMongod(configure['mongod'], configure['port'] + 1)]
+        configure['src'], configure['dest'] = mongods[0].url, mongods[1].url
+    src, dst = compare.MongoCluster(configure['src'], 'src'), compare.MongoCluster(configure['dest'], 'dst')
+    sc, dc = src.connect(), dst.connect()
+    results = []
+    try:
+        for spec in configure['dataset']:
+            if configure['seed']:
+                seed(sc, dc, spec)
+            for name in configure['runs']:
+                best = None
+                for _ in range(configure['repeat']):
+                    result = run_once(sc, dc, spec, name)
+                    if best is None or result['docs_per_sec'] > best['docs_per_sec']:
+                        best = result
+                # 内存峰值单独跑一次记录，不影响计时的运行
+                best['peak_mem_kb'] = run_once(sc, dc, spec, name, trace=True)['peak_mem_kb']
+                results.append(best)
+                log_info("bench [%s/%s] status=%s checked=%d wall=%.2fs docs/s=%.0f roundtrips=%d/%d bytes=%d/%d peak_mem=%dKB" % (
+                    best['coll'], best['run'], 'ok' if best['status'] else 'diff', best['checked'], best['wall'], best['docs_per_sec'],
+                    best['src_roundtrips'], best['dst_roundtrips'], best['src_bytes'], best['dst_bytes'], best['peak_mem_kb']))
+    finally:
+        src.close()
+        dst.close()
+        for mongod in mongods:
+            mongod.stop()
+        compare.shutdown_pools()
+
+    log_info('bench summary\n----------------------------------------')
+    for result in results:
+        print('%-20s %-14s %10.0f docs/s %8.2fs  checked=%d' % (result['coll'], result['run'], result['docs_per_sec'], result['wall'], result['checked']))
+    if configure['save_baseline']:
+        compare.write_atomic(configure['save_baseline'], json.dumps(dict(('%s/%s' % (r['coll'], r['run']), r) for r in results), indent=2, sort_keys=True))
+        log_info("baseline saved to [%s]" % configure['save_baseline'])
+    if configure['baseline']:
+        with open(configure['baseline']) as f:
+            if check_baseline(results, json.load(f), configure['tolerance']):
+                sys.exit(1)
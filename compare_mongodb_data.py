@@ -2,12 +2,41 @@
 # -*- coding:utf-8 -*-
 
 import pymongo
+from pymongo import monitoring
+import bson
 import time
 import sys
 import getopt
+import os
 import math
-import queue
-from threading import Thread
+import random
+import re
+import struct
+import json
+import bisect
+import copy
+import contextvars
+import multiprocessing
+from collections import deque
+import datetime
+import uuid
+from threading import Thread, Lock, BoundedSemaphore, Event
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from bson.objectid import ObjectId
+from bson.decimal128 import Decimal128
+from bson.timestamp import Timestamp
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from bson.regex import Regex
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python3.8以下没有共享内存，原始bson通过管道传给进程池
+    shared_memory = None
 
 '''
 参考：https://github.com/alibaba/MongoShake/blob/develop/scripts/comparison.py
@@ -30,12 +59,102 @@ SAMPLE = "sample"
 THREADS = 'threads'
 BATCH_SIZE = 'batch_size'
 SS = 'sample_skip'
+CURSOR_BATCH = 'cursor_batch'
+SPLIT_THRESHOLD = 'split_threshold'
+SPLIT_RANGES = 'split_ranges'
+RANGE_THREADS = 'range_threads'
+HASH_LEAF_SIZE, HASH_FANOUT = 'hash_leaf_size', 'hash_fanout'
+EXACT_COUNT = 'exact_count'
+MAX_INFLIGHT = 'max_inflight'
+CHECKPOINT_FILE, RESUME = 'checkpoint', 'resume'
+FOLLOW, FOLLOW_LAG, FOLLOW_DURATION = 'follow', 'follow_lag', 'follow_duration'
+RAW_BSON = 'raw_bson'
+PROCESSES = 'processes'
+BATCH_MIN, BATCH_MAX, BATCH_TARGET_MS = 'batch_min', 'batch_max', 'batch_target_ms'
+MAX_OPS, MAX_BYTES = 'max_ops', 'max_bytes'
+REPORT_JSON, REPORT_PROM, REPORT_INTERVAL = 'report_json', 'report_prom', 'report_interval'
+SHARD_DIRECT = 'shard_direct'
+FIELDS, IGNORE_FIELDS, HASH_FIELDS = 'fields', 'ignore_fields', 'hash_fields'
+CONFIDENCE, MISMATCH_RATE, SAMPLE_STRATA = 'confidence', 'mismatch_rate', 'sample_strata'
+DIFF_FILE, MAX_MISMATCHES, RECHECK_DELAY = 'diff_file', 'max_mismatches', 'recheck_delay'
 # we don't check collections and index here because sharding's collection(`db.stats`) is splitted.
 CheckList = {"objects": 1, "numExtents": 1, "ok": 1}
-configure = dict()
-configure['compare_result'] = {}
-configure['compare_info'] = {}
-SRC_VERSION = 0
+# 当前在执行的Comparator，线程池中的任务沿用提交者的，见Comparator和submit()
+COMPARATOR = contextvars.ContextVar('comparator', default=None)
+
+
+def current():
+    # 当前的Comparator，没有时(如直接调用模块中的函数)用模块级的默认实例
+    return COMPARATOR.get() or DEFAULT
+
+
+class Current(object):
+    # 转发到当前Comparator的attr属性，模块中的函数照旧当全局变量用，不用关心自己属于哪一对集群
+    def __init__(self, attr):
+        self.attr = attr
+
+    def target(self):
+        return getattr(current(), self.attr)
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+    def __getitem__(self, key):
+        return self.target()[key]
+
+    def __setitem__(self, key, value):
+        self.target()[key] = value
+
+    def __contains__(self, key):
+        return key in self.target()
+
+    def __iter__(self):
+        return iter(self.target())
+
+    def __bool__(self):
+        # 断点文件、令牌桶等没有创建时为None
+        return self.target() is not None
+
+
+# 以下是当前Comparator的同名属性的代理，每一对集群的对比各有一份
+# configure: 配置，以及对比结果compare_result、compare_info和compare_merged(汇总行已经是最终结果的namespace，汇总时不再合并compare_info)
+# META_CACHE: 集合元数据快照 (client, namespace) -> Future(CollectionMeta)
+# SCHEDULER: 多线程对比时的任务调度器  CHECKPOINT: 断点文件，--checkpoint指定时创建
+# METRICS: 性能统计  DIFF_LOG: 不一致文档的记录  PROJECTIONS: 各namespace读取文档时用的投影，None表示取整个文档
+# OPS_BUCKET, BYTES_BUCKET: 限速的令牌桶，--max-ops/--max-bytes指定时创建
+configure = Current('configure')
+META_CACHE = Current('meta_cache')
+SCHEDULER = Current('scheduler')
+CHECKPOINT = Current('checkpoint')
+METRICS = Current('metrics')
+DIFF_LOG = Current('diff_log')
+PROJECTIONS = Current('projections')
+OPS_BUCKET, BYTES_BUCKET = Current('ops_bucket'), Current('bytes_bucket')
+# 后台预取元数据用的线程池，进程内共用
+META_LOCK = Lock()
+META_POOL = None
+SERVER_VERSION = {}
+# 集合按_id范围切分后，各范围共用的对比线程池，进程内共用
+RANGE_POOL = None
+POOL_LOCK = Lock()
+# 每个集群同时在执行的对比任务数限制
+INFLIGHT = {}
+INFLIGHT_LOCK = Lock()
+RAW_CODEC = CodecOptions(document_class=RawBSONDocument)
+# 解码和对比文档的进程池，--processes指定时创建
+PROCESS_POOL = None
+# 常见_id类型的值长度，doc_id按此从原始bson中截出_id字段: bson类型 -> 定长字节数或-1(int32长度前缀)
+RAW_ID_SIZE = {0x01: 8, 0x07: 12, 0x09: 8, 0x10: 4, 0x12: 8, 0x13: 16, 0x02: -1, 0x03: -1, 0x05: -1}
+# 各集群支持的摘要方式，探测一次后缓存
+DIGEST_KIND = {}
+# hash模式摘要展开文档的层数，有更深的子文档或数组的范围摘要不能保证数值精度，要逐条对比
+DIGEST_DEPTH = 4
+# 各集群读命令的服务端耗时监控 client -> LatencyMonitor
+LATENCY = {}
+# 连接串 client -> url，--shard-direct连接分片时沿用其中的认证信息，以及已建立的分片连接 (client, 分片名) -> MongoClient
+CLUSTER_URL = {}
+SHARD_CLIENTS = {}
+SHARD_LOCK = Lock()
 
 
 def log_info(message):
@@ -46,39 +165,1630 @@ def log_error(message):
     print("ERROR [%s] %s " % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
 
 
+def write_atomic(path, content):
+    # 先写临时文件再改名，进程被杀也不会留下半个文件
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
 class MongoCluster(object):
     # connection string
     url = ""
 
-    def __init__(self, url):
+    def __init__(self, url, side):
         self.url = url
         self.conn = None
+        self.monitor = LatencyMonitor(side)
 
     def connect(self):
-        self.conn = pymongo.MongoClient(self.url)
+        self.conn = pymongo.MongoClient(self.url, event_listeners=[self.monitor])
+        LATENCY[self.conn] = self.monitor
+        CLUSTER_URL[self.conn] = self.url
         return self.conn
 
     def close(self):
+        if self.conn is None:
+            return
+        # 按连接缓存的信息随连接一起清理，同一进程中反复对比时不会越积越多
+        with SHARD_LOCK:
+            for key in [key for key in SHARD_CLIENTS if key[0] is self.conn]:
+                SHARD_CLIENTS.pop(key).close()
+        for cache in (LATENCY, CLUSTER_URL, SERVER_VERSION, DIGEST_KIND, INFLIGHT):
+            cache.pop(self.conn, None)
         self.conn.close()
+        self.conn = None
 
 
-class QThreads(Thread):
-    # 多线程
-    def __init__(self, iq, func, **kwargs):
-        Thread.__init__(self)
-        self.q = iq
-        self.func = func
-        self.kwargs = kwargs
-        self._return = None
+class LatencyMonitor(monitoring.CommandListener):
+    '''
+    统计一个集群上读命令(find/getMore/aggregate)的服务端往返耗时，每次耗时按namespace计入METRICS的直方图
+    取样和归并对比读文档的命令按返回的每行文档的耗时，分namespace算快慢两个指数移动平均，快的反映当前耗时，慢的作为基线，
+    快的明显高于基线说明源端负载升高；按行数归一化，批大小变化不会被当成负载变化，
+    按namespace分开，切换到文档更大的集合或多个集合并发对比时，文档大小的差异不会被当成负载变化
+    摘要、切分点和元数据等命令耗时和行数无关，tailable游标带maxTimeMS的getMore会在服务端等待新数据，都不计入基线
+    '''
+    # 命令名 -> 命令中集合名所在的字段
+    COMMANDS = {'find': 'find', 'getMore': 'collection', 'aggregate': 'aggregate'}
 
-    def run(self):
+    def __init__(self, side):
+        self.side = side
+        # namespace -> [快的平均, 慢的平均]
+        self.baselines = {}
+        # request_id -> (namespace, 是否计入基线)，以及计入基线的命令打开的游标
+        self.requests = {}
+        self.cursors = set()
+
+    def sampled(self, event):
+        # 是否是取样或归并对比读取文档的命令: 读业务库的find(只取_id的切分点查询除外)、$sample，以及它们游标的getMore
+        command = event.command
+        if event.database_name in ('admin', 'config', 'local'):
+            return False
+        if event.command_name == 'find':
+            return command.get('projection') != {'_id': 1}
+        if event.command_name == 'aggregate':
+            pipeline = command.get('pipeline') or [{}]
+            return '$sample' in pipeline[0]
+        return command.get('getMore') in self.cursors
+
+    def started(self, event):
+        if event.command_name == 'killCursors':
+            for cursor_id in event.command.get('cursors') or []:
+                self.cursors.discard(cursor_id)
+        if event.command_name not in self.COMMANDS:
+            return
+        if event.command_name == 'getMore' and 'maxTimeMS' in event.command:
+            return
+        coll = event.command.get(self.COMMANDS[event.command_name])
+        if isinstance(coll, str):
+            self.requests[event.request_id] = ('%s.%s' % (event.database_name, coll), self.sampled(event))
+
+    def succeeded(self, event):
+        ns, sampled = self.requests.pop(event.request_id, (None, False))
+        if ns is None:
+            return
+        seconds = event.duration_micros / 1000000.0
+        METRICS.roundtrip(self.side, ns, seconds)
+        cursor = event.reply.get('cursor') or {}
+        if not sampled:
+            return
+        if event.command_name == 'getMore' and not cursor.get('id'):
+            self.cursors.discard(event.command.get('getMore'))
+        elif event.command_name != 'getMore' and cursor.get('id'):
+            self.cursors.add(cursor['id'])
+        docs = len(cursor.get('firstBatch', cursor.get('nextBatch')) or [])
+        if docs == 0:
+            return
+        seconds /= docs
+        baseline = self.baselines.get(ns)
+        if baseline is None:
+            self.baselines[ns] = [seconds, seconds]
+        else:
+            baseline[0] = baseline[0] * 0.8 + seconds * 0.2
+            baseline[1] = baseline[1] * 0.99 + seconds * 0.01
+
+    def failed(self, event):
+        self.requests.pop(event.request_id, None)
+
+    def backoff(self, ns, seconds):
+        '''
+        集合的每行耗时超过它自己的基线2倍时，按超出的比例放大这一批的耗时作为等待时间，最多5秒
+        :param ns: 数据库.集合的名字
+        :param seconds: 这一批的耗时
+        '''
+        fast, slow = self.baselines.get(ns, (0.0, 0.0))
+        if slow <= 0 or fast < slow * 2:
+            return 0
+        return min(seconds * (fast / slow - 1), 5)
+
+
+class CollectionMeta(object):
+    # 集合元数据快照: 行数、索引、collStats大小和服务端版本，每个namespace只取一次
+    def __init__(self, coll):
+        self.namespace = coll.full_name
+        self.version = server_version(coll.database.client)
+        self.indexes = coll.index_information()
+        try:
+            stats = coll.database.command('collstats', coll.name)
+        except pymongo.errors.PyMongoError:
+            stats = {}
+        self.size = stats.get('size', 0)
+        self.avg_obj_size = stats.get('avgObjSize', 0)
+        # collStats里的count是元数据，不用扫描集合，需要精确行数时用--exact-count=True
+        if configure[EXACT_COUNT]:
+            self.count = coll.count_documents({})
+        elif 'count' in stats:
+            self.count = stats['count']
+        else:
+            self.count = coll.estimated_document_count()
+
+
+class Checkpoint(object):
+    '''
+    断点文件: 保存已完成namespace的对比结果，以及全量对比时各_id范围的进度(下一个要对比的_id和已有的统计)
+    用bson的json_util序列化，_id的类型能原样恢复；先写临时文件再改名，进程被杀也不会留下半个文件
+    '''
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = Lock()
+        self.state = {'namespaces': {}, 'ranges': {}}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                self.state = json_util.loads(f.read())
+            log_info("resume from checkpoint [%s], %d namespaces finished" % (path, len(self.state['namespaces'])))
+
+    def save(self):
+        with self.lock:
+            write_atomic(self.path, json_util.dumps(self.state))
+
+    def finished(self, qtname):
+        # 已完成的namespace返回{'result': 汇总行, 'info': compare_info}，否则None
+        return self.state['namespaces'].get(qtname)
+
+    def done(self, qtname, result, info):
+        with self.lock:
+            self.state['namespaces'][qtname] = {'result': result, 'info': list(info) if info else None}
+            self.state['ranges'].pop(qtname, None)
+        self.save()
+
+    def ranges(self, qtname):
+        # 上次保存的各_id范围进度，没有则返回None
+        return self.state['ranges'].get(qtname)
+
+    def set_ranges(self, qtname, ranges):
+        with self.lock:
+            self.state['ranges'][qtname] = ranges
+        self.save()
+
+    def update_range(self, progress, next_id, stat, done=False):
+        with self.lock:
+            progress['next_id'], progress['stat'], progress['done'] = next_id, dict(stat), done
+        self.save()
+
+
+class Scheduler(object):
+    # 多线程对比的调度器: 线程池执行，按集合大小从大到小提交，阻塞等待并收集每个namespace的结果和异常
+    # 多个Comparator可以共用一个调度器，任务按登记它的Comparator分开，run只提交和等待自己的
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(workers)
+        self.lock = Lock()
+        self.jobs = {}
+
+    def add(self, name, size, func, **kwargs):
+        # 先登记任务，run时再按size排序提交，大集合先开始
+        with self.lock:
+            self.jobs.setdefault(COMPARATOR.get(), []).append((size, name, func, kwargs))
+
+    def run(self, callback=None):
+        '''
+        提交当前Comparator登记的任务并阻塞等待完成
+        :param callback: 每个任务完成后在当前线程调用 callback(name, result, error)
+        :return: (results, errors) 两个以name为key的dict
+        '''
+        with self.lock:
+            jobs = self.jobs.pop(COMPARATOR.get(), [])
+        futures = {}
+        for size, qtname, func, kwargs in sorted(jobs, key=lambda job: job[0], reverse=True):
+            futures[submit(self.pool, func, **kwargs)] = qtname
+        results, errors = {}, {}
+        for future in as_completed(futures):
+            qtname = futures[future]
+            try:
+                results[qtname] = future.result()
+            except Exception as e:
+                log_error("[%s] data comparison failed: %r" % (qtname, e))
+                errors[qtname] = e
+            if callback is not None:
+                callback(qtname, results.get(qtname), errors.get(qtname))
+        return results, errors
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+def submit(pool, func, *args, **kwargs):
+    # 提交到线程池，任务在提交者所属的Comparator中执行
+    return pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+def create_pools(processes=0, range_threads=0):
+    '''
+    创建进程内共用的解码进程池和范围对比线程池，已经创建的不再重复创建
+    进程池要在创建任何线程之前fork，同一进程中并发运行多个Comparator时，先按最大的--processes调用一次
+    '''
+    global PROCESS_POOL, RANGE_POOL
+    with POOL_LOCK:
+        if processes > 0 and PROCESS_POOL is None:
+            PROCESS_POOL = create_process_pool(processes)
+        if range_threads > 1 and RANGE_POOL is None:
+            RANGE_POOL = ThreadPoolExecutor(range_threads)
+
+
+def shutdown_pools():
+    # 关闭共用的线程池和进程池，之后再运行Comparator时重新创建
+    global PROCESS_POOL, RANGE_POOL, META_POOL
+    with POOL_LOCK:
+        if RANGE_POOL is not None:
+            RANGE_POOL.shutdown()
+        if PROCESS_POOL is not None:
+            PROCESS_POOL.close()
+            PROCESS_POOL.join()
+        PROCESS_POOL, RANGE_POOL = None, None
+    with META_LOCK:
+        if META_POOL is not None:
+            META_POOL.shutdown()
+        META_POOL = None
+
+
+def process_pool():
+    # 当前Comparator用的进程池，--processes为0时不用
+    return PROCESS_POOL if configure[PROCESSES] > 0 else None
+
+
+def range_pool():
+    # 当前Comparator用的范围对比线程池，--range-threads不大于1时不用
+    return RANGE_POOL if configure[RANGE_THREADS] > 1 else None
+
+
+@contextmanager
+def inflight(*colls):
+    '''
+    限制每个集群同时在执行的对比任务数(--max-inflight)，0为不限制
+    多个集群的信号量按固定顺序获取，避免互相等待
+    '''
+    if configure.get(MAX_INFLIGHT, 0) <= 0:
+        yield
+        return
+    with INFLIGHT_LOCK:
+        slots = []
+        for client in set(coll.database.client for coll in colls):
+            if client not in INFLIGHT:
+                INFLIGHT[client] = BoundedSemaphore(configure[MAX_INFLIGHT])
+            slots.append((id(client), INFLIGHT[client]))
+    slots = [slot for _, slot in sorted(slots, key=lambda x: x[0])]
+    for slot in slots:
+        slot.acquire()
+    try:
+        yield
+    finally:
+        for slot in reversed(slots):
+            slot.release()
+
+
+class TokenBucket(object):
+    # 令牌桶限速: 每秒补充rate个令牌，允许透支，透支后等到令牌补回再继续
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def throttle(docs, nbytes):
+    # 按--max-ops/--max-bytes限制所有对比线程合计读取源端的速度
+    if OPS_BUCKET:
+        OPS_BUCKET.consume(docs)
+    if BYTES_BUCKET:
+        BYTES_BUCKET.consume(nbytes)
+
+
+class BatchController(object):
+    '''
+    按集合自适应调整每批对比的行数: 每批往返耗时低于--batch-target-ms时放大1.5倍，超过目标2倍时减半，
+    放大后吞吐反而下降则退回，始终在--batch-min和--batch-max之间
+    源端读命令耗时高于基线时额外退避，并按--max-ops/--max-bytes限速
+    '''
+
+    def __init__(self, coll, size, avg_obj_size=0):
+        self.size = min(max(size, configure[BATCH_MIN]), configure[BATCH_MAX])
+        self.avg_obj_size = avg_obj_size
+        self.monitor, self.namespace = LATENCY.get(coll.database.client), coll.full_name
+        self.rate, self.grew, self.limit = 0.0, False, configure[BATCH_MAX]
+        self.docs, self.seconds = 0, 0.0
+
+    def current(self):
+        return self.size
+
+    def observe(self, docs, seconds):
+        '''
+        记录一批的行数和耗时，调整下一批的大小
+        :param docs: 这一批的行数
+        :param seconds: 这一批从读取到对比完成的耗时
+        '''
+        self.docs += docs
+        self.seconds += seconds
+        target = configure[BATCH_TARGET_MS] / 1000.0
+        rate = docs / seconds if seconds > 0 else 0
+        size, grew = self.size, False
+        if seconds > target * 2:
+            size = self.size / 2
+        elif self.grew and rate < self.rate * 0.9:
+            # 上次放大后吞吐反而下降，退回去并且以后不再超过这个大小
+            self.limit = self.size - 1
+            size = self.size / 1.5
+        elif seconds < target and self.size < self.limit:
+            size, grew = min(self.size * 1.5 + 1, self.limit), True
+        self.size = min(max(int(size), configure[BATCH_MIN]), configure[BATCH_MAX])
+        self.rate, self.grew = rate, grew
+        wait = self.monitor.backoff(self.namespace, seconds) if self.monitor is not None else 0
+        if wait > 0:
+            time.sleep(wait)
+        throttle(docs, docs * self.avg_obj_size)
+
+    def throughput(self):
+        # 平均每秒对比的行数
+        return self.docs / self.seconds if self.seconds > 0 else 0
+
+
+class Metrics(object):
+    '''
+    对比过程的性能统计，按namespace汇总: 对比行数、耗时、两端读取的字节数，fetch(读源端)/lookup(读目标端)/
+    compare(对比)/digest(hash模式的服务端摘要)各阶段耗时，以及源端和目标端读命令的往返耗时直方图
+    结束时导出--report-json和--report-prom，--report-interval指定时定期导出快照
+    '''
+    # 往返耗时直方图的桶上界(秒)
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.ns = {}
+        self.started = time.time()
+        self.stop = Event()
+
+    def entry(self, qtname):
+        # 调用方持有self.lock
+        if qtname not in self.ns:
+            self.ns[qtname] = {'docs': 0, 'elapsed': 0.0, 'running_since': None, 'src_bytes': 0, 'dst_bytes': 0,
+                               'fetch': 0.0, 'lookup': 0.0, 'compare': 0.0, 'digest': 0.0,
+                               'src': {'requests': 0, 'seconds': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1)},
+                               'dst': {'requests': 0, 'seconds': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1)}}
+        return self.ns[qtname]
+
+    def add(self, qtname, **values):
+        with self.lock:
+            entry = self.entry(qtname)
+            for key, value in values.items():
+                entry[key] += value
+
+    @contextmanager
+    def running(self, qtname):
+        # 记录namespace的对比耗时，快照中正在对比的namespace按已经过的时间算
+        with self.lock:
+            self.entry(qtname)['running_since'] = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                entry = self.entry(qtname)
+                entry['elapsed'] += time.time() - entry['running_since']
+                entry['running_since'] = None
+
+    def roundtrip(self, side, qtname, seconds):
+        with self.lock:
+            hist = self.entry(qtname)[side]
+            hist['requests'] += 1
+            hist['seconds'] += seconds
+            hist['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def report(self):
+        # 当前统计的快照，附上每秒对比行数
+        now = time.time()
+        with self.lock:
+            namespaces = copy.deepcopy(self.ns)
+        for entry in namespaces.values():
+            running_since = entry.pop('running_since')
+            if running_since is not None:
+                entry['elapsed'] += now - running_since
+            entry['docs_per_sec'] = entry['docs'] / entry['elapsed'] if entry['elapsed'] > 0 else 0
+        return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'elapsed': now - self.started,
+                'buckets': list(self.BUCKETS), 'namespaces': namespaces}
+
+    def prometheus(self, report):
+        # prometheus textfile格式，直方图的桶是累计值
+        lines = []
+
+        def metric(name, kind, text, samples):
+            lines.append('# HELP mongo_compare_%s %s' % (name, text))
+            lines.append('# TYPE mongo_compare_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                label = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+                lines.append('mongo_compare_%s%s{%s} %r' % (name, suffix, label, float(value)))
+
+        items = sorted(report['namespaces'].items())
+        metric('docs_total', 'counter', 'Documents compared.', [('', [('ns', ns)], e['docs']) for ns, e in items])
+        metric('elapsed_seconds', 'gauge', 'Wall time spent comparing the namespace.', [('', [('ns', ns)], e['elapsed']) for ns, e in items])
+        metric('docs_per_second', 'gauge', 'Documents compared per second.', [('', [('ns', ns)], e['docs_per_sec']) for ns, e in items])
+        metric('bytes_read_total', 'counter', 'Bytes read from the cluster.',
+               [('', [('ns', ns), ('side', side)], e[side + '_bytes']) for ns, e in items for side in ('src', 'dst')])
+        metric('phase_seconds_total', 'counter', 'Time spent in each comparison phase.',
+               [('', [('ns', ns), ('phase', phase)], e[phase]) for ns, e in items for phase in ('fetch', 'lookup', 'compare', 'digest')])
+        samples = []
+        for ns, e in items:
+            for side in ('src', 'dst'):
+                hist, count = e[side], 0
+                for le, n in zip(report['buckets'] + ['+Inf'], hist['buckets']):
+                    count += n
+                    samples.append(('_bucket', [('ns', ns), ('side', side), ('le', le)], count))
+                samples.append(('_sum', [('ns', ns), ('side', side)], hist['seconds']))
+                samples.append(('_count', [('ns', ns), ('side', side)], hist['requests']))
+        metric('roundtrip_seconds', 'histogram', 'Read command round-trip latency.', samples)
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        report = self.report()
+        if configure[REPORT_JSON]:
+            write_atomic(configure[REPORT_JSON], json.dumps(report, indent=2, sort_keys=True))
+        if configure[REPORT_PROM]:
+            write_atomic(configure[REPORT_PROM], self.prometheus(report))
+
+    def start(self, interval):
+        # 后台线程每interval秒导出一次快照
+        def run():
+            while not self.stop.wait(interval):
+                self.export()
+        thread = Thread(target=contextvars.copy_context().run, args=(run,))
+        thread.daemon = True
+        thread.start()
+
+
+class MeteredCursor(object):
+    '''
+    包装游标，累计取回的字节数和等待游标的时间，flush()取出增量计入METRICS
+    原始bson按实际长度计算，已解码的文档按collStats的平均文档大小估算
+    '''
+
+    def __init__(self, cursor, avg_obj_size, phase, side):
+        self.cursor = cursor
+        self.avg_obj_size = avg_obj_size
+        self.phase, self.side = phase, side
+        self.seconds, self.bytes = 0.0, 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
         try:
-            self._return = self.func(**self.kwargs)
-        except Exception as e:
-            print(e)
+            doc = next(self.cursor)
         finally:
-            self.q.get()
-            self.q.task_done()
+            self.seconds += time.time() - start
+        self.bytes += len(doc.raw) if isinstance(doc, RawBSONDocument) else self.avg_obj_size
+        return doc
+
+    next = __next__
+
+    def flush(self):
+        values = {self.phase: self.seconds, self.side + '_bytes': self.bytes}
+        self.seconds, self.bytes = 0.0, 0
+        return values
+
+
+def docs_size(docs, avg_obj_size):
+    # 一批文档的字节数，计算方式同MeteredCursor
+    return sum(len(doc.raw) if isinstance(doc, RawBSONDocument) else avg_obj_size for doc in docs)
+
+
+def server_version(client):
+    # 服务端版本，如4.0.x返回40，每个集群只取一次
+    if client not in SERVER_VERSION:
+        version = client.server_info()['version']
+        SERVER_VERSION[client] = int(''.join(version.split('.')[:2]))
+    return SERVER_VERSION[client]
+
+
+def prefetch_meta(colls):
+    '''
+    在后台线程池里并发获取集合元数据，当前集合做数据对比时，后面集合的count等命令已经在执行
+    :param colls: collection实例列表
+    :return: list Future
+    '''
+    global META_POOL
+    futures = []
+    with META_LOCK:
+        if META_POOL is None:
+            META_POOL = ThreadPoolExecutor(4)
+        for coll in colls:
+            key = (coll.database.client, coll.full_name)
+            if key not in META_CACHE:
+                META_CACHE[key] = submit(META_POOL, CollectionMeta, coll)
+            futures.append(META_CACHE[key])
+    return futures
+
+
+def get_meta(coll):
+    # 取集合元数据快照，没有预取过的当场获取
+    return prefetch_meta([coll])[0].result()
+
+
+def ns_fields(option, ns, options=None):
+    # 取--fields等选项中namespace对应的字段列表，精确的namespace优先，其次db.*，最后*，options默认为当前的configure
+    options = configure if options is None else options
+    db = ns.split('.', 1)[0]
+    for key in (ns, db + '.*', '*'):
+        if key in options[option]:
+            return options[option][key]
+    return []
+
+
+def prepare_projection(srcColl, dstColl):
+    '''
+    按--fields/--ignore-fields/--hash-fields生成namespace的投影，两端读取文档时用同一个投影，只传输要对比的字段
+    hash字段用$toHashedIndexKey在服务端算成64位hash再传回来，要求两端都支持$toHashedIndexKey并且是4.4+(find投影支持表达式)，
+    否则原样读取这些字段
+    :return: dict 投影，None表示取整个文档
+    '''
+    ns = srcColl.full_name
+    if ns in PROJECTIONS:
+        return PROJECTIONS[ns]
+    fields, ignored, hashed = ns_fields(FIELDS, ns), ns_fields(IGNORE_FIELDS, ns), ns_fields(HASH_FIELDS, ns)
+    projection = None
+    if fields:
+        projection = dict((field, 1) for field in fields if field not in ignored)
+        if hashed:
+            if all(digest_kind(coll) == 'hashed' and server_version(coll.database.client) >= 44 for coll in (srcColl, dstColl)):
+                projection.update((field, {'$toHashedIndexKey': '$' + field}) for field in hashed)
+            else:
+                log_info("[%s] hash projection not supported, read hash fields as is" % ns)
+                projection.update((field, 1) for field in hashed)
+    elif ignored:
+        projection = dict((field, 0) for field in ignored)
+    PROJECTIONS[ns] = projection
+    return projection
+
+
+def projection(coll):
+    # prepare_projection生成的投影
+    return PROJECTIONS.get(coll.full_name)
+
+
+def id_key(_id):
+    # 内存中按_id匹配文档用的key，嵌套文档类型的_id不能hash，转成bson字节
+    if isinstance(_id, (dict, list)):
+        return bson.BSON.encode({'_id': _id})
+    return _id
+
+
+def iter_batches(docs, size):
+    # 把游标按size切成一批一批的文档列表，size可以是返回当前批大小的函数
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= (size() if callable(size) else size):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def doc_coll(coll):
+    # 读取要对比的文档用的collection，--raw-bson时不解码，文档是RawBSONDocument
+    return coll.with_options(codec_options=RAW_CODEC) if configure.get(RAW_BSON) else coll
+
+
+def doc_id(doc):
+    '''
+    取文档的_id，RawBSONDocument只截出第一个字段_id解码，不解码整个文档
+    '''
+    if not isinstance(doc, RawBSONDocument):
+        return doc['_id']
+    raw = doc.raw
+    # 第一个字段: 类型(1字节) + '_id\x00' + 值
+    if raw[5:9] != b'_id\x00' or raw[4] not in RAW_ID_SIZE:
+        return doc['_id']
+    size = RAW_ID_SIZE[raw[4]]
+    if size < 0:
+        # string: int32长度+内容, 文档: int32总长度, binary: int32长度+subtype+内容
+        size = struct.unpack('<i', raw[9:13])[0] + {0x02: 4, 0x03: 0, 0x05: 5}[raw[4]]
+    element = raw[4:9 + size]
+    return bson.BSON(struct.pack('<i', len(element) + 5) + element + b'\x00').decode()['_id']
+
+
+def to_dict(doc):
+    # RawBSONDocument完整解码成dict
+    return bson.BSON(doc.raw).decode() if isinstance(doc, RawBSONDocument) else doc
+
+
+def docs_equal(doc, migrated):
+    '''
+    文档是否一致: RawBSONDocument先比较原始字节，字节不同时才解码后比较(和dict一样与字段顺序无关)
+    '''
+    if isinstance(doc, RawBSONDocument) and isinstance(migrated, RawBSONDocument):
+        if doc.raw == migrated.raw:
+            return True
+        return to_dict(doc) == to_dict(migrated)
+    # both origin and migrated bson is Map . so use ==
+    return doc == migrated
+
+
+def doc_diff(src, dst, path=''):
+    # 与字段顺序无关的结构化对比，返回不一致的字段路径
+    if isinstance(src, dict) and isinstance(dst, dict):
+        fields = []
+        for k in sorted(set(src) | set(dst)):
+            field = path + '.' + k if path else k
+            if k not in dst:
+                fields.append(field + '(only in src)')
+            elif k not in src:
+                fields.append(field + '(only in dst)')
+            else:
+                fields += doc_diff(src[k], dst[k], field)
+        return fields
+    if isinstance(src, list) and isinstance(dst, list) and len(src) == len(dst):
+        fields = []
+        for i in range(len(src)):
+            fields += doc_diff(src[i], dst[i], '%s.%d' % (path, i))
+        return fields
+    return [] if src == dst else [path]
+
+
+def diff_report(qtname, doc, migrated):
+    # 不一致文档的日志，附上不一致的字段
+    doc, migrated = to_dict(doc), to_dict(migrated)
+    return "DIFF => [%s] src_record[%s], dst_record[%s], diff fields: %s" % (qtname, doc, migrated, ', '.join(doc_diff(doc, migrated)))
+
+
+class DiffLog(object):
+    '''
+    不一致文档的记录: 每个namespace最多保留--max-mismatches个_id供复查，同时流式写入--diff-file，不在内存中堆积
+    文件扩展名为.bson时逐条写bson，否则每行一个json_util格式的json，_id的类型都能原样还原
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        # namespace -> {id_key: (_id, 类型, 发现时间)}，以及每个namespace发现的不同_id总数(含超过保留个数没有记下的)
+        self.ids = {}
+        self.found = {}
+        # 达到--max-mismatches后提前结束、没有对比完的namespace
+        self.stopped = set()
+        self.file, self.raw = None, False
+
+    def open(self, path):
+        self.raw = path.endswith('.bson')
+        self.file = open(path, 'ab' if self.raw else 'a')
+
+    def write(self, ns, kind, _id, fields=None, phase='compare'):
+        '''
+        :param kind: src_only/dst_only/diff，复查时一致的记为transient
+        :param phase: compare初始对比，recheck复查，follow跟踪模式的复查
+        '''
+        if self.file is None:
+            return
+        record = {'ns': ns, 'kind': kind, '_id': _id, 'fields': fields, 'phase': phase, 'time': datetime.datetime.now(datetime.timezone.utc)}
+        with self.lock:
+            self.file.write(bson.encode(record) if self.raw else json_util.dumps(record) + '\n')
+            self.file.flush()
+
+    def add(self, ns, kind, _id, fields=None):
+        # 初始对比发现的不一致，返回是否已达到--max-mismatches
+        with self.lock:
+            ids, key = self.ids.setdefault(ns, {}), id_key(_id)
+            # 同一个_id再次发现(如$sample重复取到)只更新发现时间，不重复计数
+            if key not in ids:
+                self.found[ns] = self.found.get(ns, 0) + 1
+            if key in ids or len(ids) < configure[MAX_MISMATCHES]:
+                ids[key] = (_id, kind, time.time())
+        self.write(ns, kind, _id, fields)
+        return self.full(ns)
+
+    def full(self, ns):
+        return self.found.get(ns, 0) >= configure[MAX_MISMATCHES]
+
+    def pending(self, ns):
+        # 待复查的不一致，list (_id, 类型, 发现时间)
+        with self.lock:
+            return list(self.ids.get(ns, {}).values())
+
+    def truncated(self, ns):
+        # 发现的不一致超过了保留的个数，或者达到个数后提前结束了对比，复查不能覆盖全部
+        return self.found.get(ns, 0) > len(self.ids.get(ns, {})) or ns in self.stopped
+
+    def stop(self, ns):
+        # 达到--max-mismatches提前结束对比，剩下的文档没有对比过，复查后也不能算一致
+        with self.lock:
+            self.stopped.add(ns)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def lookup_batch(dstColl, docs):
+    '''
+    一次{_id: {$in: [...]}}查询取回目标端对应的文档，代替逐条find_one
+    :param dstColl: 目标端collection实例
+    :param docs: 源端文档列表
+    :return: dict id_key(_id) -> 目标端文档
+    '''
+    ids = [doc_id(doc) for doc in docs]
+    return dict((id_key(doc_id(m)), m) for m in doc_coll(dstColl).find({'_id': {'$in': ids}}, projection(dstColl)))
+
+
+def compare_raw(src_buf, dst_buf):
+    '''
+    进程池worker: 解码两边拼接在一起的原始bson，按_id匹配并对比，只返回结论和不一致的_id
+    :param src_buf: 源端文档的原始bson拼接
+    :param dst_buf: 目标端同一_id范围内文档的原始bson拼接
+    :return: dict {'checked': 源端行数, 'src_only': [_id], 'dst_only': [_id], 'diff': [(_id, 不一致的字段)]}
+    '''
+    src_docs = bson.decode_all(src_buf)
+    dst_docs = dict((id_key(doc['_id']), doc) for doc in bson.decode_all(dst_buf))
+    result = {'checked': len(src_docs), 'src_only': [], 'dst_only': [], 'diff': []}
+    for doc in src_docs:
+        dst_doc = dst_docs.pop(id_key(doc['_id']), None)
+        if dst_doc is None:
+            result['src_only'].append(doc['_id'])
+        elif doc != dst_doc:
+            result['diff'].append((doc['_id'], doc_diff(doc, dst_doc)))
+    result['dst_only'] = [doc['_id'] for doc in dst_docs.values()]
+    return result
+
+
+def compare_raw_shm(name, src_len, dst_len):
+    # 进程池worker: 直接在共享内存上解码，不再经过管道复制
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        src_buf, dst_buf = shm.buf[:src_len], shm.buf[src_len:src_len + dst_len]
+        try:
+            return compare_raw(src_buf, dst_buf)
+        finally:
+            src_buf.release()
+            dst_buf.release()
+    finally:
+        shm.close()
+
+
+def create_process_pool(processes):
+    '''
+    创建解码对比用的进程池，要在创建任何线程之前fork
+    先启动resource_tracker，worker继承同一个，共享内存的登记和释放都由主进程完成
+    '''
+    if shared_memory is not None:
+        resource_tracker.ensure_running()
+    return multiprocessing.Pool(processes)
+
+
+class RawTask(object):
+    # 提交给进程池的一批原始bson，get()取到结果后释放共享内存
+    def __init__(self, src_docs, dst_docs):
+        src_len, dst_len = sum(len(doc.raw) for doc in src_docs), sum(len(doc.raw) for doc in dst_docs)
+        self.shm = None
+        if shared_memory is None:
+            self.result = PROCESS_POOL.apply_async(compare_raw, (b''.join(doc.raw for doc in src_docs), b''.join(doc.raw for doc in dst_docs)))
+            return
+        # 原始bson直接写进共享内存，worker在共享内存上解码
+        self.shm = shared_memory.SharedMemory(create=True, size=max(src_len + dst_len, 1))
+        offset = 0
+        for doc in list(src_docs) + list(dst_docs):
+            self.shm.buf[offset:offset + len(doc.raw)] = doc.raw
+            offset += len(doc.raw)
+        self.result = PROCESS_POOL.apply_async(compare_raw_shm, (self.shm.name, src_len, dst_len))
+
+    def ready(self):
+        return self.result.ready()
+
+    def get(self):
+        try:
+            return self.result.get()
+        finally:
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+                self.shm = None
+
+
+def log_raw_result(qtname, result):
+    # 进程池对比结果的日志
+    for _id in result['src_only']:
+        log_error("DIFF => [%s] src_record _id[%r] not exists in dst" % (qtname, _id))
+        DIFF_LOG.add(qtname, 'src_only', _id)
+    for _id in result['dst_only']:
+        log_error("DIFF => [%s] dst_record _id[%r] not exists in src" % (qtname, _id))
+        DIFF_LOG.add(qtname, 'dst_only', _id)
+    for _id, fields in result['diff']:
+        log_error("DIFF => [%s] record _id[%r] not equals, diff fields: %s" % (qtname, _id, ', '.join(fields)))
+        DIFF_LOG.add(qtname, 'diff', _id, fields)
+
+
+def raw_window():
+    # 进程池模式每个读取线程同时在途的块数，每个worker进程一块在对比、一块在排队
+    return max(configure[PROCESSES] * 2, 2)
+
+
+def lookup_timed(dstColl, docs, qtname):
+    # lookup_batch并计入目标端的查找耗时和读取字节数
+    lookup_start = time.time()
+    migrated = lookup_batch(dstColl, docs)
+    METRICS.add(qtname, lookup=time.time() - lookup_start, dst_bytes=docs_size(migrated.values(), get_meta(dstColl).avg_obj_size))
+    return migrated
+
+
+class BatchPipeline(object):
+    '''
+    进程池模式的批量对比: 当前线程查找目标端后把两边的原始bson交给进程池，不等结果就去读取下一批，
+    同时最多raw_window()批在途，--processes个worker都有活干；不用进程池时直接调用compare_batch
+    '''
+
+    def __init__(self, dstColl, qtname):
+        self.dstColl, self.qtname = dstColl, qtname
+        # (RawTask, 行数)
+        self.pending = deque()
+
+    def submit(self, docs):
+        '''
+        :param docs: 源端文档列表
+        :return: list 已经对比完的批的(missing, diff)，格式同compare_batch，进程池对比时diff为(_id, 不一致的字段)列表
+        '''
+        if process_pool() is None:
+            return [compare_batch(docs, self.dstColl, self.qtname)] if docs else []
+        if docs:
+            migrated = lookup_timed(self.dstColl, docs, self.qtname)
+            compare_start = time.time()
+            self.pending.append((RawTask(docs, list(migrated.values())), len(docs)))
+            METRICS.add(self.qtname, compare=time.time() - compare_start)
+        return self.collect(raw_window())
+
+    def collect(self, window):
+        # 取回已经完成的批，在途的批多于window时等待最早的一批
+        done = []
+        while len(self.pending) > window or (self.pending and self.pending[0][0].ready()):
+            task, n = self.pending.popleft()
+            compare_start = time.time()
+            result = task.get()
+            log_raw_result(self.qtname, result)
+            METRICS.add(self.qtname, docs=n, compare=time.time() - compare_start)
+            done.append((result['src_only'], result['diff']))
+        return done
+
+    def drain(self):
+        # 等待所有在途的批
+        return self.collect(0)
+
+
+def compare_batch(docs, dstColl, qtname):
+    '''
+    批量对比一批源端文档，目标端缺失和数据不一致分开报告
+    :param docs: 源端文档列表
+    :param dstColl: 目标端collection实例
+    :param qtname: 数据库.集合的名字
+    :return: (missing, diff) 目标端缺失的_id列表, 不一致的(源端文档, 目标端文档)列表
+    '''
+    migrated = lookup_timed(dstColl, docs, qtname)
+    compare_start = time.time()
+    missing, diff = [], []
+    for doc in docs:
+        dst_doc = migrated.get(id_key(doc_id(doc)))
+        if dst_doc is None:
+            missing.append(doc_id(doc))
+        elif not docs_equal(doc, dst_doc):
+            diff.append((doc, dst_doc))
+    for _id in missing:
+        log_error("DIFF => [%s] src_record _id[%r] not exists in dst" % (qtname, _id))
+        DIFF_LOG.add(qtname, 'src_only', _id)
+    for doc, dst_doc in diff:
+        log_error(diff_report(qtname, doc, dst_doc))
+        DIFF_LOG.add(qtname, 'diff', doc_id(doc), doc_diff(to_dict(doc), to_dict(dst_doc)))
+    METRICS.add(qtname, docs=len(docs), compare=time.time() - compare_start)
+    return missing, diff
+
+
+def bson_sort_key(value):
+    '''
+    按mongodb服务端的排序规则生成可比较的key，用于在内存中比较两边游标的_id先后
+    类型之间的顺序: MinKey < null < 数字 < 字符串 < 文档 < 数组 < 二进制 < ObjectId < bool < 日期 < Timestamp < 正则 < MaxKey
+    '''
+    if isinstance(value, MinKey):
+        return (1,)
+    if value is None:
+        return (2,)
+    if isinstance(value, bool):
+        return (9, value)
+    if isinstance(value, float) and value != value:
+        # NaN小于所有数字
+        return (3, float('-inf'))
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, Decimal128):
+        return (3, value.to_decimal())
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, dict):
+        return (5, tuple((bson_sort_key(v)[0], k, bson_sort_key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (6, tuple(bson_sort_key(v) for v in value))
+    if isinstance(value, bytes):
+        return (7, len(value), getattr(value, 'subtype', 0), bytes(value))
+    if isinstance(value, uuid.UUID):
+        # uuidRepresentation=standard时pymongo把subtype 4的二进制解码成UUID，服务端仍按二进制排序
+        return (7, 16, 4, value.bytes)
+    if isinstance(value, ObjectId):
+        return (8, value.binary)
+    if isinstance(value, datetime.datetime):
+        return (10, value)
+    if isinstance(value, Timestamp):
+        return (11, value.time, value.inc)
+    if isinstance(value, (Regex, type(re.compile('')))):
+        return (12, value.pattern, str(value.flags))
+    if isinstance(value, MaxKey):
+        return (14,)
+    return (13, repr(value))
+
+
+def range_cursor(coll, lower=None, upper=None):
+    '''
+    按_id索引顺序读取[lower, upper)范围内的文档
+    用min/max指定索引边界而不用$gte/$lt，是因为后者只匹配同类型的_id，混合类型的_id会漏掉
+    显式按_id排序，mongos才会在各分片之间归并排序，不依赖索引扫描的顺序
+    '''
+    cursor = doc_coll(coll).find({}, projection(coll)).sort([("_id", 1)]).hint([("_id", 1)]).batch_size(configure[CURSOR_BATCH])
+    if lower is not None:
+        cursor = cursor.min([("_id", lower)])
+    if upper is not None:
+        cursor = cursor.max([("_id", upper)])
+    return cursor
+
+
+def merge_join_comparison(srcColl, dstColl, qtname, lower=None, upper=None, progress=None):
+    '''
+    全量对比: 源端和目标端各开一个按_id排序的游标，像归并一样同步推进，
+    一次遍历就能找出仅源端有、仅目标端有以及数据不一致的文档，内存中只保留游标的一批数据
+    :param srcColl: 源端collection实例
+    :param dstColl: 目标端collection实例
+    :param qtname: 数据库.集合的名字
+    :param lower: _id范围下界(包含)，None表示从头开始
+    :param upper: _id范围上界(不包含)，None表示到集合末尾
+    :param progress: 断点文件中此范围的进度，指定时从上次的位置继续并定期保存进度
+    :return: dict 对比统计 {'checked': 源端检查行数, 'src_only': 仅源端有, 'dst_only': 仅目标端有, 'diff': 不一致}
+    '''
+    if progress is not None and progress['done']:
+        return dict(progress['stat'])
+    with inflight(srcColl, dstColl):
+        return merge_join_range(srcColl, dstColl, qtname, lower, upper, progress)
+
+
+def merge_join_range(srcColl, dstColl, qtname, lower, upper, progress=None):
+    # merge_join_comparison的归并过程
+    stat = {'checked': 0, 'src_only': 0, 'dst_only': 0, 'diff': 0}
+    if progress is not None and progress['stat']:
+        stat = dict(progress['stat'])
+        lower = progress['next_id'] if progress['next_id'] is not None else lower
+        log_info(" [%s] ... resume merge from _id[%r], %d docs processed !" % (qtname, lower, stat['checked']))
+    src_docs = MeteredCursor(range_cursor(srcColl, lower, upper), get_meta(srcColl).avg_obj_size, 'fetch', 'src')
+    dst_docs = MeteredCursor(range_cursor(dstColl, lower, upper), get_meta(dstColl).avg_obj_size, 'lookup', 'dst')
+    # 游标批大小固定，只用来按源端耗时退避和限速
+    controller = BatchController(srcColl, configure[CURSOR_BATCH], get_meta(srcColl).avg_obj_size)
+    if process_pool() is not None:
+        return merge_join_chunks(src_docs, dst_docs, qtname, progress, stat, controller)
+    show_progress = configure[CURSOR_BATCH] * 100
+    batch_start = time.time()
+    metered = (stat['checked'], time.time())
+    src_doc, dst_doc = next(src_docs, None), next(dst_docs, None)
+    while src_doc is not None or dst_doc is not None:
+        if dst_doc is None:
+            order = -1
+        elif src_doc is None:
+            order = 1
+        else:
+            src_key, dst_key = bson_sort_key(doc_id(src_doc)), bson_sort_key(doc_id(dst_doc))
+            order = -1 if src_key < dst_key else (1 if src_key > dst_key else 0)
+
+        if order < 0:
+            log_error("DIFF => [%s] src_record _id[%r] not exists in dst" % (qtname, doc_id(src_doc)))
+            DIFF_LOG.add(qtname, 'src_only', doc_id(src_doc))
+            stat['src_only'] += 1
+        elif order > 0:
+            log_error("DIFF => [%s] dst_record _id[%r] not exists in src" % (qtname, doc_id(dst_doc)))
+            DIFF_LOG.add(qtname, 'dst_only', doc_id(dst_doc))
+            stat['dst_only'] += 1
+        elif not docs_equal(src_doc, dst_doc):
+            log_error(diff_report(qtname, src_doc, dst_doc))
+            DIFF_LOG.add(qtname, 'diff', doc_id(src_doc), doc_diff(to_dict(src_doc), to_dict(dst_doc)))
+            stat['diff'] += 1
+
+        if order <= 0:
+            stat['checked'] += 1
+            src_doc = next(src_docs, None)
+            if stat['checked'] % configure[CURSOR_BATCH] == 0:
+                controller.observe(configure[CURSOR_BATCH], time.time() - batch_start)
+                batch_start = time.time()
+        if order >= 0:
+            dst_doc = next(dst_docs, None)
+        if order <= 0 and stat['checked'] % show_progress == 0:
+            metered = record_merge(qtname, src_docs, dst_docs, stat, metered)
+            log_info(" [%s] ... merge process %d docs !" % (qtname, stat['checked']))
+            if progress is not None:
+                # 两边游标当前文档中较小的_id之前的都已对比完，下次从这里继续
+                pending = [doc_id(doc) for doc in (src_doc, dst_doc) if doc is not None]
+                CHECKPOINT.update_range(progress, min(pending, key=bson_sort_key) if pending else None, stat)
+    record_merge(qtname, src_docs, dst_docs, stat, metered)
+    if progress is not None:
+        CHECKPOINT.update_range(progress, None, stat, done=True)
+    return stat
+
+
+def record_merge(qtname, src_docs, dst_docs, stat, metered):
+    '''
+    归并对比的统计计入METRICS: 等待源端游标的时间算fetch，等待目标端游标的时间算lookup，其余算compare
+    :param metered: 上次计入时的(已对比行数, 时间)
+    :return: 这次计入时的(已对比行数, 时间)
+    '''
+    now = time.time()
+    src, dst = src_docs.flush(), dst_docs.flush()
+    METRICS.add(qtname, docs=stat['checked'] - metered[0], compare=now - metered[1] - src['fetch'] - dst['lookup'], **dict(src, **dst))
+    return stat['checked'], now
+
+
+def merge_join_chunks(src_docs, dst_docs, qtname, progress, stat, controller):
+    '''
+    进程池模式的归并对比: 当前线程只负责读取，按源端每CURSOR_BATCH行切块，
+    目标端取到同一_id位置为止，两边的原始bson交给进程池解码对比，同时最多raw_window()块在途
+    :param src_docs: 源端按_id排序的游标
+    :param dst_docs: 目标端按_id排序的游标
+    :param progress: 断点文件中此范围的进度
+    :param stat: 对比统计，原地累加
+    :param controller: 源端的BatchController，每读完一块做退避和限速
+    '''
+    size, show_progress = configure[CURSOR_BATCH], configure[CURSOR_BATCH] * 100
+    pending = deque()
+
+    def collect(task):
+        result = task.get()
+        log_raw_result(qtname, result)
+        stat['checked'] += result['checked']
+        stat['src_only'] += len(result['src_only'])
+        stat['dst_only'] += len(result['dst_only'])
+        stat['diff'] += len(result['diff'])
+
+    read = stat['checked']
+    metered = (stat['checked'], time.time())
+    src_doc, dst_doc = next(src_docs, None), next(dst_docs, None)
+    while src_doc is not None or dst_doc is not None:
+        chunk_start = time.time()
+        src_chunk = []
+        while src_doc is not None and len(src_chunk) < size:
+            src_chunk.append(src_doc)
+            src_doc = next(src_docs, None)
+        # 目标端取到源端这一块最后一个_id为止，源端读完后剩下的目标端文档按块大小切
+        last = bson_sort_key(doc_id(src_chunk[-1])) if src_chunk else None
+        dst_chunk = []
+        while dst_doc is not None and (bson_sort_key(doc_id(dst_doc)) <= last if last is not None else len(dst_chunk) < size):
+            dst_chunk.append(dst_doc)
+            dst_doc = next(dst_docs, None)
+        controller.observe(len(src_chunk), time.time() - chunk_start)
+        pending.append(RawTask(src_chunk, dst_chunk))
+        while len(pending) > raw_window() or (pending and pending[0].ready()):
+            collect(pending.popleft())
+
+        read += len(src_chunk)
+        if int(read / show_progress) != int((read - len(src_chunk)) / show_progress):
+            while pending:
+                collect(pending.popleft())
+            metered = record_merge(qtname, src_docs, dst_docs, stat, metered)
+            log_info(" [%s] ... merge process %d docs !" % (qtname, stat['checked']))
+            if progress is not None:
+                next_ids = [doc_id(doc) for doc in (src_doc, dst_doc) if doc is not None]
+                CHECKPOINT.update_range(progress, min(next_ids, key=bson_sort_key) if next_ids else None, stat)
+    while pending:
+        collect(pending.popleft())
+    record_merge(qtname, src_docs, dst_docs, stat, metered)
+    if progress is not None:
+        CHECKPOINT.update_range(progress, None, stat, done=True)
+    return stat
+
+
+def pick_boundaries(keys, parts):
+    # 从排好序的_id中等间隔取parts-1个切分点，去掉重复的
+    keys = sorted(keys, key=bson_sort_key)
+    if parts <= 1 or len(keys) == 0:
+        return []
+    boundaries = []
+    for i in range(1, parts):
+        key = keys[int(len(keys) * i / parts)]
+        if not boundaries or bson_sort_key(boundaries[-1]) < bson_sort_key(key):
+            boundaries.append(key)
+    return boundaries
+
+
+def split_id_ranges(srcColl, parts):
+    '''
+    把集合按_id切成parts个左闭右开的范围，依次尝试:
+    splitVector(按索引切分，开销最小) -> $sample采样取分位点 -> $bucketAuto
+    :param srcColl: 源端collection实例
+    :param parts: 要切分的范围个数
+    :return: list [(lower, upper), ...]，None表示开区间
+    '''
+    boundaries = []
+    meta = get_meta(srcColl)
+    try:
+        size = meta.size
+        split_keys = srcColl.database.command('splitVector', srcColl.full_name, keyPattern={'_id': 1},
+                                              maxChunkSizeBytes=max(int(size / parts), 1024 * 1024))['splitKeys']
+        boundaries = pick_boundaries([k['_id'] for k in split_keys], min(parts, len(split_keys) + 1))
+    except pymongo.errors.PyMongoError as e:
+        log_info("[%s] splitVector not available (%s), try sampled boundaries" % (srcColl.full_name, e))
+    if not boundaries and meta.version >= configure[SS]:
+        docs = srcColl.aggregate([{"$sample": {"size": parts * 20}}, {"$project": {"_id": 1}}])
+        boundaries = pick_boundaries([doc['_id'] for doc in docs], parts)
+    if not boundaries and meta.version >= 34:
+        buckets = srcColl.aggregate([{"$bucketAuto": {"groupBy": "$_id", "buckets": parts}}], allowDiskUse=True)
+        boundaries = [b['_id']['min'] for b in buckets][1:]
+    log_info("[%s] split into %d _id ranges" % (srcColl.full_name, len(boundaries) + 1))
+    bounds = [None] + boundaries + [None]
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def ranged_merge_join(srcColl, dstColl, qtname, count, start):
+    '''
+    大集合按_id范围切分，各范围在共用的线程池RANGE_POOL里并发做归并对比，
+    每完成一个范围就把进度合并到compare_info[qtname]，汇总时仍是一个集合一行
+    有断点文件时各范围的进度记在断点里，--resume时沿用上次的切分并从保存的位置继续
+    :param count: 源端集合行数
+    :param start: 开始对比的时间
+    :return: dict 对比统计，同merge_join_comparison
+    '''
+    pool = range_pool()
+    ranges = CHECKPOINT.ranges(qtname) if CHECKPOINT else None
+    if ranges is None:
+        if pool is None or count < configure[SPLIT_THRESHOLD]:
+            bounds = [(None, None)]
+        else:
+            bounds = split_id_ranges(srcColl, configure[SPLIT_RANGES])
+        ranges = [{'lower': lower, 'upper': upper, 'next_id': None, 'stat': None, 'done': False} for lower, upper in bounds]
+        if CHECKPOINT:
+            CHECKPOINT.set_ranges(qtname, ranges)
+    progresses = ranges if CHECKPOINT else [None] * len(ranges)
+    if len(ranges) == 1:
+        return merge_join_comparison(srcColl, dstColl, qtname, ranges[0]['lower'], ranges[0]['upper'], progresses[0])
+
+    if pool is None:
+        results = (merge_join_comparison(srcColl, dstColl, qtname, r['lower'], r['upper'], p) for r, p in zip(ranges, progresses))
+    else:
+        results = as_completed([submit(pool, merge_join_comparison, srcColl, dstColl, qtname, r['lower'], r['upper'], p)
+                                for r, p in zip(ranges, progresses)])
+    stat = {'checked': 0, 'src_only': 0, 'dst_only': 0, 'diff': 0}
+    done = 0
+    for result in results:
+        for k, v in (result if pool is None else result.result()).items():
+            stat[k] += v
+        done += 1
+        status = stat['src_only'] == 0 and stat['dst_only'] == 0 and stat['diff'] == 0
+        configure['compare_info'][qtname] = (status, count, stat['checked'], int(time.time()) - start,
+                                             {'src_only': stat['src_only'], 'dst_only': stat['dst_only'], 'diff': stat['diff'],
+                                              'ranges': '%d/%d' % (done, len(ranges))})
+        log_info(" [%s] ... range %d/%d done, process %d docs !" % (qtname, done, len(ranges), stat['checked']))
+    stat['ranges'] = len(ranges)
+    return stat
+
+
+def range_filter(lower=None, upper=None):
+    # 左闭右开的_id范围查询条件，调用方保证两端_id是同一类型
+    condition = {}
+    if lower is not None:
+        condition['$gte'] = lower
+    if upper is not None:
+        condition['$lt'] = upper
+    return {'_id': condition} if condition else {}
+
+
+def digest_kind(coll):
+    '''
+    探测集群能在服务端计算什么样的文档摘要:
+    hashed: $toHashedIndexKey对展开后的文档求hash，见digest_value; count: 只能数行数，不能证明范围一致，退回全量归并对比
+    ($bsonSize之和看不出长度不变的修改，如int 1改成2，不能当作摘要)
+    '''
+    client = coll.database.client
+    if client not in DIGEST_KIND:
+        DIGEST_KIND[client] = 'count'
+        try:
+            list(coll.aggregate([{'$limit': 1}, {'$group': digest_group('hashed')}]))
+            DIGEST_KIND[client] = 'hashed'
+        except pymongo.errors.OperationFailure:
+            pass
+    return DIGEST_KIND[client]
+
+
+def digest_value(expr, depth):
+    '''
+    $toHashedIndexKey先把double和Decimal128截成64位整数再求hash(子文档和数组里也是)，9.99改成9.5时hash不变，
+    所以求hash前先展开文档: 小数转成字符串(double保留17位有效数字，不会丢精度)，子文档和数组逐层展开，
+    都带上类型标记，不同类型展开后不会相同
+    :param expr: 要展开的值的表达式
+    :param depth: 还能展开的层数，为0时原样返回，见digest_deep
+    '''
+    if depth == 0:
+        return expr
+    var = 'v%d' % depth
+    value = '$$' + var
+    return {'$let': {'vars': {var: expr}, 'in': {'$switch': {'branches': [
+        {'case': {'$in': [{'$type': value}, ['double', 'decimal']]}, 'then': [{'$type': value}, {'$toString': value}]},
+        {'case': {'$eq': [{'$type': value}, 'object']},
+         'then': ['object', {'$map': {'input': {'$objectToArray': value}, 'as': 'f', 'in': ['$$f.k', digest_value('$$f.v', depth - 1)]}}]},
+        {'case': {'$eq': [{'$type': value}, 'array']},
+         'then': ['array', {'$map': {'input': value, 'as': 'a', 'in': digest_value('$$a', depth - 1)}}]},
+    ], 'default': value}}}}
+
+
+def digest_deep(expr, depth):
+    # 值在展开depth层之后是否还有子文档或数组，有时为1；这些没有展开的部分里的小数仍会被截断
+    if depth == 0:
+        return {'$cond': [{'$in': [{'$type': expr}, ['object', 'array']]}, 1, 0]}
+    var = 'v%d' % depth
+    value = '$$' + var
+    return {'$let': {'vars': {var: expr}, 'in': {'$switch': {'branches': [
+        {'case': {'$eq': [{'$type': value}, 'object']},
+         'then': {'$max': {'$map': {'input': {'$objectToArray': value}, 'as': 'f', 'in': digest_deep('$$f.v', depth - 1)}}}},
+        {'case': {'$eq': [{'$type': value}, 'array']},
+         'then': {'$max': {'$map': {'input': value, 'as': 'a', 'in': digest_deep('$$a', depth - 1)}}}},
+    ], 'default': 0}}}}
+
+
+def digest_group(kind):
+    '''
+    计算范围摘要的$group阶段，hash先取模再求和，避免NumberLong溢出成double后结果和求和顺序有关
+    deep为嵌套超过DIGEST_DEPTH层的文档数，不为0时摘要相同也不能证明范围一致
+    '''
+    group = {'_id': None, 'n': {'$sum': 1}}
+    if kind == 'hashed':
+        group['h'] = {'$sum': {'$mod': [{'$toHashedIndexKey': digest_value('$$ROOT', DIGEST_DEPTH)}, 2147483647]}}
+        group['deep'] = {'$sum': digest_deep('$$ROOT', DIGEST_DEPTH)}
+    return group
+
+
+def bucket_digests(coll, kind, lower, upper, points):
+    '''
+    一次聚合算出[lower, upper)按切分点分成的各个桶的摘要，每个桶只有一行结果传回客户端
+    :param points: 范围内排好序的切分点，len(points)+1个桶
+    :return: list 各个桶的摘要，顺序同桶的顺序，没有文档的桶为{'n': 0}
+    '''
+    start = time.time()
+    # 有投影时摘要只覆盖投影后的字段
+    pipeline = [{'$match': range_filter(lower, upper)}] + ([{'$project': projection(coll)}] if projection(coll) else [])
+    group = digest_group(kind)
+    if points:
+        # 切分点用$literal，避免以$开头的字符串_id被当成字段路径
+        group['_id'] = {'$switch': {'branches': [{'case': {'$lt': ['$_id', {'$literal': point}]}, 'then': i} for i, point in enumerate(points)],
+                                    'default': len(points)}}
+    with inflight(coll):
+        docs = list(coll.aggregate(pipeline + [{'$group': group}]))
+    METRICS.add(coll.full_name, digest=time.time() - start)
+    digests = [{'n': 0} for _ in range(len(points) + 1)]
+    for doc in docs:
+        digests[doc.pop('_id') or 0] = doc
+    # 摘要在服务端扫描了n行，同样计入限速
+    n = sum(digest['n'] for digest in digests)
+    throttle(n, n * get_meta(coll).avg_obj_size)
+    return digests
+
+
+def leaf_boundaries(srcColl):
+    '''
+    每--hash-leaf-size行取一个_id作为桶的切分点，优先用splitVector在服务端按行数切分，
+    不可用时(如mongos)用只读_id的覆盖查询按顺序扫描一遍_id索引
+    '''
+    leaf, meta = configure[HASH_LEAF_SIZE], get_meta(srcColl)
+    try:
+        # splitVector每maxChunkSizeBytes的一半和maxChunkObjects行中较少的一个切一次，集合小于maxChunkSizeBytes时不切分
+        split_keys = srcColl.database.command('splitVector', srcColl.full_name, keyPattern={'_id': 1}, maxChunkObjects=leaf,
+                                              maxChunkSizeBytes=2 * leaf * max(meta.avg_obj_size, 1))['splitKeys']
+        return [k['_id'] for k in split_keys]
+    except pymongo.errors.PyMongoError as e:
+        log_info("[%s] splitVector not available (%s), scan _id index for hash buckets" % (srcColl.full_name, e))
+    boundaries = []
+    cursor = srcColl.find({}, {'_id': 1}).sort([("_id", 1)]).hint([("_id", 1)]).batch_size(configure[CURSOR_BATCH])
+    for i, doc in enumerate(cursor):
+        if i > 0 and i % leaf == 0:
+            boundaries.append(doc['_id'])
+    return boundaries
+
+
+def hash_compare_buckets(srcColl, dstColl, qtname, kind, buckets):
+    '''
+    对比一组相邻的桶: 两端各用一次聚合算出每个桶的摘要，摘要不同的桶才逐条归并对比
+    桶里有嵌套过深的文档时摘要相同也不能证明一致，同样逐条对比
+    :param kind: 摘要方式，见digest_kind
+    :param buckets: 相邻的_id范围 [(lower, upper), ...]
+    :return: dict 对比统计
+    '''
+    lower, upper, points = buckets[0][0], buckets[-1][1], [bucket_upper for _, bucket_upper in buckets[:-1]]
+    src_digests = bucket_digests(srcColl, kind, lower, upper, points)
+    dst_digests = bucket_digests(dstColl, kind, lower, upper, points)
+    stat = {'checked': 0, 'src_only': 0, 'dst_only': 0, 'diff': 0, 'ranges_hashed': len(buckets), 'leaf_ranges': 0}
+    for (bucket_lower, bucket_upper), src_digest, dst_digest in zip(buckets, src_digests, dst_digests):
+        if src_digest == dst_digest and not src_digest.get('deep'):
+            continue
+        stat['leaf_ranges'] += 1
+        for k, v in merge_join_comparison(srcColl, dstColl, qtname, bucket_lower, bucket_upper).items():
+            stat[k] += v
+    return stat
+
+
+def hash_comparison(srcColl, dstColl, qtname, count, start):
+    '''
+    hash模式: 按_id把集合切成每--hash-leaf-size行一个桶，两端在服务端算出每个桶的摘要并比较，只有摘要不同的桶才把文档传到客户端对比
+    数据基本一致时，传输量从整个集合降到每个桶一行摘要，不一致分散在各处时两端也只各扫描一遍集合
+    :param count: 源端集合行数
+    :param start: 开始对比的时间
+    :return: dict 对比统计
+    '''
+    kind = digest_kind(srcColl)
+    if kind == 'count' or digest_kind(dstColl) != kind:
+        log_info("[%s] server side document digest not supported, use full merge comparison" % qtname)
+        return ranged_merge_join(srcColl, dstColl, qtname, count, start)
+    # $match的范围条件只匹配同类型的_id，所以要求两端_id最小值和最大值的类型一致
+    edges = []
+    for coll in (srcColl, dstColl):
+        for direction in (1, -1):
+            doc = next(coll.find({}, {'_id': 1}).sort([("_id", direction)]).limit(1), None)
+            if doc is not None:
+                edges.append(bson_sort_key(doc['_id'])[0])
+    if len(set(edges)) > 1:
+        log_info("[%s] _id has mixed types, use full merge comparison" % qtname)
+        return ranged_merge_join(srcColl, dstColl, qtname, count, start)
+
+    # 按源端每--hash-leaf-size行切成桶，每--hash-fanout个相邻的桶一次聚合，两端各只扫描一遍集合
+    bounds = [None] + leaf_boundaries(srcColl) + [None]
+    buckets = [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+    groups = [buckets[i:i + configure[HASH_FANOUT]] for i in range(0, len(buckets), configure[HASH_FANOUT])]
+    log_info("[%s] hash %d buckets in %d aggregations" % (qtname, len(buckets), len(groups)))
+    pool = range_pool()
+    if pool is None:
+        results = (hash_compare_buckets(srcColl, dstColl, qtname, kind, group) for group in groups)
+    else:
+        results = (future.result() for future in as_completed([submit(pool, hash_compare_buckets, srcColl, dstColl, qtname, kind, group)
+                                                               for group in groups]))
+    stat = {'checked': 0, 'src_only': 0, 'dst_only': 0, 'diff': 0, 'ranges_hashed': 0, 'leaf_ranges': 0}
+    for result in results:
+        for k, v in result.items():
+            stat[k] += v
+    return stat
+
+
+def shard_client(client, shard):
+    '''
+    直接连接源端的一个分片，优先读secondary，每个分片只连接一次
+    认证信息和其他连接参数沿用源端mongos的连接串，所以分片上要有同名的用户
+    :param client: 源端mongos的MongoClient
+    :param shard: config.shards中的文档，host形如 rs0/h1:27018,h2:27018
+    '''
+    key = (client, shard['_id'])
+    with SHARD_LOCK:
+        if key not in SHARD_CLIENTS:
+            parsed = pymongo.uri_parser.parse_uri(CLUSTER_URL[client])
+            options = dict((k, v) for k, v in parsed['options'].items()
+                           if k.lower() not in ('replicaset', 'readpreference', 'readpreferencetags', 'directconnection'))
+            if parsed['username']:
+                options['username'], options['password'] = parsed['username'], parsed['password']
+            name, _, hosts = shard['host'].rpartition('/')
+            if name:
+                options['replicaSet'] = name
+            monitor = LatencyMonitor('src')
+            conn = pymongo.MongoClient(hosts.split(','), readPreference='secondaryPreferred', event_listeners=[monitor], **options)
+            LATENCY[conn] = monitor
+            SHARD_CLIENTS[key] = conn
+        return SHARD_CLIENTS[key]
+
+
+def shard_chunks(srcColl):
+    '''
+    从源端config库读取集合的分片键和chunk分布
+    :return: (分片键, {分片名: [chunk]})，集合没有分片时返回(None, None)
+    '''
+    config = srcColl.database.client['config']
+    meta = config['collections'].find_one({'_id': srcColl.full_name})
+    if meta is None or meta.get('dropped'):
+        return None, None
+    # 5.0开始config.chunks按集合的uuid而不是namespace关联
+    query = {'ns': srcColl.full_name}
+    if 'uuid' in meta:
+        query = {'$or': [query, {'uuid': meta['uuid']}]}
+    chunks = {}
+    for chunk in config['chunks'].find(query).sort([('min', 1)]):
+        chunks.setdefault(chunk['shard'], []).append(chunk)
+    return meta['key'], chunks
+
+
+def shard_compare_chunks(shardColl, dstColl, qtname, key, chunks):
+    '''
+    一个分片上的worker: 按chunk范围直接从分片读取文档，到目标端批量查找对比
+    只读这个分片拥有的chunk，迁移后没有清理的孤儿文档不会被读到
+    :return: dict 对比统计
+    '''
+    stat = {'checked': 0, 'src_only': 0, 'diff': 0, 'chunks': 0}
+    meta = get_meta(shardColl)
+    controller = BatchController(shardColl, configure[CURSOR_BATCH], meta.avg_obj_size)
+    pipeline = BatchPipeline(dstColl, qtname)
+
+    def count(results):
+        for missing, diff in results:
+            stat['src_only'] += len(missing)
+            stat['diff'] += len(diff)
+    with inflight(shardColl, dstColl):
+        for chunk in chunks:
+            cursor = doc_coll(shardColl).find({}, projection(shardColl)).hint(list(key.items())).min(list(chunk['min'].items())) \
+                .max(list(chunk['max'].items())).batch_size(configure[CURSOR_BATCH])
+            docs = MeteredCursor(cursor, meta.avg_obj_size, 'fetch', 'src')
+            batch_start = time.time()
+            for batch in iter_batches(docs, configure[CURSOR_BATCH]):
+                METRICS.add(qtname, **docs.flush())
+                count(pipeline.submit(batch))
+                stat['checked'] += len(batch)
+                controller.observe(len(batch), time.time() - batch_start)
+                batch_start = time.time()
+            stat['chunks'] += 1
+        count(pipeline.drain())
+    return stat
+
+
+def shard_comparison(srcColl, dstColl, qtname, count, start):
+    '''
+    --shard-direct的全量对比: 按config.chunks把集合分到各分片，每个分片一个worker直接连接分片读取自己的chunk，
+    读取压力分散到整个源端集群，不再都经过一个mongos
+    分片键不一定是_id，所以用目标端按_id批量查找的方式对比，仅目标端有的文档由行数对比发现
+    集合没有分片时退回普通的归并对比
+    :param count: 源端集合行数
+    :param start: 开始对比的时间
+    :return: dict 对比统计
+    '''
+    key, chunks = shard_chunks(srcColl)
+    if not chunks:
+        return ranged_merge_join(srcColl, dstColl, qtname, count, start)
+    shards = dict((shard['_id'], shard) for shard in srcColl.database.client['config']['shards'].find())
+    log_info("[%s] read %d chunks directly from %d shards" % (qtname, sum(len(c) for c in chunks.values()), len(chunks)))
+    stat = {'checked': 0, 'src_only': 0, 'dst_only': 0, 'diff': 0, 'shards': len(chunks), 'chunks': 0}
+    with ThreadPoolExecutor(len(chunks)) as pool:
+        futures = []
+        for name, shard_chunk_list in chunks.items():
+            shardColl = shard_client(srcColl.database.client, shards[name])[srcColl.database.name][srcColl.name]
+            futures.append(submit(pool, shard_compare_chunks, shardColl, dstColl, qtname, key, shard_chunk_list))
+        for future in as_completed(futures):
+            for k, v in future.result().items():
+                stat[k] += v
+            status = stat['src_only'] == 0 and stat['diff'] == 0
+            configure['compare_info'][qtname] = (status, count, stat['checked'], int(time.time()) - start,
+                                                 {'src_only': stat['src_only'], 'diff': stat['diff'], 'chunks': stat['chunks']})
+    return stat
+
+
+def id_interpolator(min_id, max_id):
+    '''
+    返回在min_id和max_id之间按比例插值生成_id的函数，_id类型不支持插值时返回None
+    ObjectId按12字节整数插值，高4字节是时间戳，所以相当于按插入时间均匀取点
+    :return: function r(0-1) -> _id
+    '''
+    if isinstance(min_id, ObjectId) and isinstance(max_id, ObjectId):
+        lo, hi = int.from_bytes(min_id.binary, 'big'), int.from_bytes(max_id.binary, 'big')
+        return lambda r: ObjectId((lo + int((hi - lo) * r)).to_bytes(12, 'big'))
+    if isinstance(min_id, bool) or isinstance(max_id, bool):
+        return None
+    if isinstance(min_id, int) and isinstance(max_id, int):
+        return lambda r: min_id + int((max_id - min_id) * r)
+    if isinstance(min_id, (int, float)) and isinstance(max_id, (int, float)):
+        return lambda r: min_id + (max_id - min_id) * r
+    if isinstance(min_id, datetime.datetime) and isinstance(max_id, datetime.datetime):
+        return lambda r: min_id + (max_id - min_id) * r
+    return None
+
+
+def id_sampler(srcColl, boundaries=None):
+    '''
+    取集合_id的最小值和最大值(两次索引seek)生成插值函数
+    :param boundaries: 行数大致相等的_id切分点(split_id_ranges)，指定时先随机选一段再在段内插值，
+                       _id分布不均(如ObjectId按时间成批写入)时样本仍大致均匀
+    '''
+    edges = []
+    for direction in (1, -1):
+        doc = next(srcColl.find({}, {'_id': 1}).sort([("_id", direction)]).limit(1), None)
+        if doc is None:
+            return None
+        edges.append(doc['_id'])
+    points = [edges[0]] + list(boundaries or []) + [edges[1]]
+    segments = [id_interpolator(points[i], points[i + 1]) for i in range(len(points) - 1)]
+    if None in segments:
+        log_info("[%s] _id type %s can not seek sample, use skip sample" % (srcColl.full_name, type(edges[0]).__name__))
+        return None
+    if len(segments) == 1:
+        return segments[0]
+
+    def sampler(r):
+        i = min(int(r * len(segments)), len(segments) - 1)
+        return segments[i](r * len(segments) - i)
+    return sampler
+
+
+def seek_sample(srcColl, sampler, size):
+    '''
+    低版本的取样方法: 随机生成_id后用{_id: {$gte: key}}在索引上定位，取第一条
+    每个样本只需要一次索引seek，并且分布在整个集合中，代替skip()的线性扫描
+    :param sampler: id_interpolator返回的插值函数
+    :param size: 要取的样本数
+    :return: list 去重后的源端文档
+    '''
+    docs = {}
+    for _ in range(size * 2):
+        doc = next(doc_coll(srcColl).find({'_id': {'$gte': sampler(random.random())}}, projection(srcColl)).sort([("_id", 1)]).limit(1), None)
+        if doc is not None:
+            docs[id_key(doc_id(doc))] = doc
+        if len(docs) >= size:
+            break
+    return list(docs.values())
+
+
+def sample_size(population, confidence, rate):
+    '''
+    零失败验收抽样的样本数: 集合中不一致的比例达到rate时，n个随机样本全部一致的概率(1-rate)^n不超过1-confidence，
+    再按有限总体修正(不放回抽样)
+    :param population: 集合行数
+    :param confidence: 置信度，如0.99
+    :param rate: 可容忍的不一致比例，如0.001
+    '''
+    if population <= 0:
+        return 0
+    n = math.log(1 - confidence) / math.log(1 - rate)
+    n = n / (1 + (n - 1) / population)
+    return min(int(math.ceil(n)), population)
+
+
+def mismatch_bound(checked, population, confidence):
+    # checked个样本全部一致时，不一致比例在confidence置信度下的上界，sample_size的反推
+    if checked >= population:
+        return 0.0
+    if checked <= 0:
+        return 1.0
+    n = checked * (population - 1.0) / (population - checked)
+    return 1 - (1 - confidence) ** (1.0 / n)
+
+
+def confidence_extra(checked, population):
+    # --confidence指定时，汇总信息中附上达到的置信上界
+    if configure[CONFIDENCE] <= 0:
+        return None
+    return {'confidence': '%g%%' % (configure[CONFIDENCE] * 100),
+            'mismatch_rate<=': '%.4f%%' % (mismatch_bound(checked, population, configure[CONFIDENCE]) * 100)}
+
+
+class Strata(object):
+    '''
+    分层抽样的配额: 用split_id_ranges的切分点把_id分成行数大致相等的若干层，各层分到相同的样本数，
+    取回的样本按_id落到对应的层，层的配额满了就丢弃，重复的样本也丢弃
+    '''
+
+    def __init__(self, boundaries, size):
+        self.keys = [bson_sort_key(boundary) for boundary in boundaries]
+        parts = len(boundaries) + 1
+        self.quota = [int(size / parts) + (1 if i < size % parts else 0) for i in range(parts)]
+        self.seen = set()
+
+    def accept(self, docs):
+        accepted = []
+        for doc in docs:
+            key = id_key(doc_id(doc))
+            if key in self.seen:
+                continue
+            i = bisect.bisect_right(self.keys, bson_sort_key(doc_id(doc)))
+            if self.quota[i] > 0:
+                self.quota[i] -= 1
+                self.seen.add(key)
+                accepted.append(doc)
+        return accepted
+
+
+def compare_info_extra(qtname):
+    # compare_info第5项是各对比模式附加的统计信息，拼到汇总信息里
+    info = configure['compare_info'].get(qtname)
+    if not info or len(info) < 5 or not info[4]:
+        return ''
+    return ', ' + ', '.join('%s:%s' % (k, v) for k, v in info[4].items())
 
 
 def check(src, dst):
@@ -128,9 +1838,6 @@ def check(src, dst):
         # db.stats() comparison
         srcDb = src[db]
         dstDb = dst[db]
-        version = srcDb.command('buildinfo')['version']
-        global SRC_VERSION
-        SRC_VERSION = int(''.join(version.split('.')[:2]))
 
         # for collections in db
         srcColls = srcDb.list_collection_names()
@@ -144,35 +1851,47 @@ def check(src, dst):
                 return False
         else:
             log_info("EQUL => database [%s] collections count equals = %d " % (db, len(srcColls)))
+        # 本库所有集合的元数据在后台预取
+        prefetch_meta([srcDb[coll] for coll in srcColls] + [dstDb[coll] for coll in dstColls if coll in srcColls])
 
         for coll in srcColls:
             compare_coll_status = 0
             if coll in configure[EXCLUDE_COLLS]:
                 log_info("IGNR => ignore collection [%s]" % coll)
                 continue
+            qtname = db + '.' + coll
+            finished = CHECKPOINT.finished(qtname) if CHECKPOINT else None
+            if finished is not None:
+                log_info("SKIP => collection [%s] finished in checkpoint" % qtname)
+                configure['compare_result'][qtname] = finished['result']
+                if finished['info'] is not None:
+                    configure['compare_info'][qtname] = tuple(finished['info'])
+                configure['compare_merged'].add(qtname)
+                continue
 
             if coll not in dstColls:
                 if not configure['compare_result'].get('dst_not_exists_coll'):
                     configure['compare_result']['dst_not_exists_coll'] = []
                 configure['compare_result']['dst_not_exists_coll'].append(
-                    'XXXX [%s.%s],collection only in source,doc count:%s' % (db, coll, srcDb[coll].count()))
+                    'XXXX [%s.%s],collection only in source,doc count:%s' % (db, coll, get_meta(srcDb[coll]).count))
                 log_error("DIFF => collection only in source [%s]" % (coll))
                 if not configure[CONTINUE]:
                     return False
 
             srcColl = srcDb[coll]
             dstColl = dstDb[coll]
+            src_meta, dst_meta = get_meta(srcColl), get_meta(dstColl)
             # comparison collection records number
-            if srcColl.count() != dstColl.count():
-                log_error("DIFF => collection [%s.%s] record count not equals , src[%d] -> dst[%d]" % (db, coll, srcColl.count(), dstColl.count()))
+            if src_meta.count != dst_meta.count:
+                log_error("DIFF => collection [%s.%s] record count not equals , src[%d] -> dst[%d]" % (db, coll, src_meta.count, dst_meta.count))
                 if not configure[CONTINUE]:
                     return False
             else:
-                log_info("EQUL => collection [%s.%s] record count equals , src:%d = dst:%d" % (db, coll, srcColl.count(), dstColl.count()))
+                log_info("EQUL => collection [%s.%s] record count equals , src:%d = dst:%d" % (db, coll, src_meta.count, dst_meta.count))
                 compare_coll_status += 1
             # comparison collection index number
-            src_index_length = len(srcColl.index_information())
-            dst_index_length = len(dstColl.index_information())
+            src_index_length = len(src_meta.indexes)
+            dst_index_length = len(dst_meta.indexes)
             if src_index_length != dst_index_length:
                 log_error("DIFF => collection [%s.%s] index number not equals: src[%r], dst[%r]" % (db, coll, src_index_length, dst_index_length))
                 if not configure[CONTINUE]:
@@ -182,43 +1901,43 @@ def check(src, dst):
                 compare_coll_status += 0.5
 
             # check sample data
-            qtname = db + '.' + coll
             if configure[THREADS] <= 1:
                 status, check_rowcount, cost_time = data_comparison(srcColl, dstColl, configure[COMPARISION_MODE], configure[LATEST_SIZE],
                                                                     configure[FULL_CHECK_SIZE],
                                                                     configure[CHECK_PERC], qtname)
                 if not status:
                     log_error("DIFF => collection [%s.%s] data comparison not equals, check row count: %s, cost time(s): %s, src rowcount:%s" % (
-                        db, coll, check_rowcount, cost_time, srcColl.count()))
+                        db, coll, check_rowcount, cost_time, src_meta.count))
                     if not configure[CONTINUE]:
                         return False
                 else:
                     log_info("EQUL => collection [%s.%s] data data comparison exactly eauals, check row count: %s, cost time(s): %s, src rowcount:%s" % (
-                        db, coll, check_rowcount, cost_time, srcColl.count()))
+                        db, coll, check_rowcount, cost_time, src_meta.count))
                     compare_coll_status += 2
 
-                add_info = "datacompare info: {}/{} check_percentage:{}%, cost time:{}s".format(check_rowcount, srcColl.count(),
+                add_info = "datacompare info: {}/{} check_percentage:{}%, cost time:{}s".format(check_rowcount, src_meta.count,
                                                                                                 round((
-                                                                                                          check_rowcount / srcColl.count() if srcColl.count() != 0 else 1) * 100,
-                                                                                                      3), cost_time)
+                                                                                                          check_rowcount / src_meta.count if src_meta.count != 0 else 1) * 100,
+                                                                                                      3), cost_time) + compare_info_extra(qtname)
                 if compare_coll_status > 3:
                     # compare ok
                     configure['compare_result'][qtname] = '=== [%s.%s],record=%r,index=%r,datacompare=%s (%s)' % (
-                        db, coll, srcColl.count(), src_index_length, 'ok', add_info)
+                        db, coll, src_meta.count, src_index_length, 'ok', add_info)
                 else:
                     configure['compare_result'][qtname] = 'XXX [%s.%s],src_dst_record=[%d:%d],src_dst_index=[%d:%d],datacompare=%s (%s)' % (
-                        db, coll, srcColl.count(), dstColl.count(), src_index_length, dst_index_length, 'err', add_info)
+                        db, coll, src_meta.count, dst_meta.count, src_index_length, dst_index_length, 'err', add_info)
+                if CHECKPOINT:
+                    CHECKPOINT.done(qtname, configure['compare_result'][qtname], configure['compare_info'].get(qtname))
+                notify(qtname)
             else:
-                q.put(0)
-                qt = QThreads(q, data_comparison,
+                SCHEDULER.add(qtname, src_meta.size, data_comparison,
                               **{"srcColl": srcColl, "dstColl": dstColl, "mode": configure[COMPARISION_MODE], "check_latest_size": configure[LATEST_SIZE],
                                  "full_check_size": configure[FULL_CHECK_SIZE], "check_perc": configure[CHECK_PERC], "qtname": qtname})
-                qt.start()
                 if compare_coll_status < 1:
                     configure['compare_result'][qtname] = 'XXX [%s.%s],src_dst_record=[%d:%d],src_dst_index=[%d:%d]' % (
-                        db, coll, srcColl.count(), dstColl.count(), src_index_length, dst_index_length)
+                        db, coll, src_meta.count, dst_meta.count, src_index_length, dst_index_length)
                 else:
-                    configure['compare_result'][qtname] = '=== [%s.%s],record=%r,index=%r' % (db, coll, srcColl.count(), src_index_length)
+                    configure['compare_result'][qtname] = '=== [%s.%s],record=%r,index=%r' % (db, coll, src_meta.count, src_index_length)
 
     return True
 
@@ -235,121 +1954,418 @@ def data_comparison(srcColl, dstColl, mode, check_latest_size=0, full_check_size
     :param qtname: 数据库.集合的名字
     :return: bool 对比是否成功
     '''
+    with METRICS.running(qtname):
+        prepare_projection(srcColl, dstColl)
+        result = mode_comparison(srcColl, dstColl, mode, check_latest_size, full_check_size, check_perc, qtname)
+    if not result[0] and configure[RECHECK_DELAY] > 0 and DIFF_LOG.pending(qtname):
+        return recheck_mismatches(srcColl, dstColl, qtname, result)
+    return result
+
+
+def recheck_mismatches(srcColl, dstColl, qtname, result):
+    '''
+    复查: 等到最后一个不一致被发现--recheck-delay秒之后，只重新读取不一致的_id，
+    两端此时一致(或都已删除)的算同步延迟造成的暂时不一致，仍然不一致的才确认，不用重新对比整个集合
+    全部是暂时不一致，并且发现的不一致都在--max-mismatches之内时，对比结果改为一致
+    :param result: data_comparison的对比结果
+    :return: 复查后的对比结果
+    '''
+    pending = DIFF_LOG.pending(qtname)
+    wait = max(found for _, _, found in pending) + configure[RECHECK_DELAY] - time.time()
+    if wait > 0:
+        log_info("[%s] recheck %d mismatches after %.0fs" % (qtname, len(pending), wait))
+        time.sleep(wait)
+    confirmed, transient = 0, 0
+    for batch in iter_batches(pending, configure[CURSOR_BATCH]):
+        keys = [{'_id': _id} for _id, _, _ in batch]
+        src_docs, dst_docs = lookup_batch(srcColl, keys), lookup_batch(dstColl, keys)
+        for _id, _, _ in batch:
+            src_doc, dst_doc = src_docs.get(id_key(_id)), dst_docs.get(id_key(_id))
+            if (src_doc is None and dst_doc is None) or (src_doc is not None and dst_doc is not None and docs_equal(src_doc, dst_doc)):
+                transient += 1
+                DIFF_LOG.write(qtname, 'transient', _id, phase='recheck')
+            else:
+                confirmed += 1
+                kind = 'dst_only' if src_doc is None else ('src_only' if dst_doc is None else 'diff')
+                log_error("DIFF => [%s] record _id[%r] still %s after recheck" % (qtname, _id, kind))
+                fields = doc_diff(to_dict(src_doc), to_dict(dst_doc)) if kind == 'diff' else None
+                DIFF_LOG.write(qtname, kind, _id, fields, phase='recheck')
+    info = configure['compare_info'][qtname]
+    extra = dict(info[4] or {}) if len(info) > 4 else {}
+    # --resume时从断点恢复的不一致只有个数没有_id，没有复查过，不能算一致
+    restored = sum(extra.get(k, 0) for k in ('src_only', 'dst_only', 'diff')) > DIFF_LOG.found.get(qtname, 0)
+    status = confirmed == 0 and not DIFF_LOG.truncated(qtname) and not restored
+    log_info("[%s] recheck done, confirmed %d, transient %d" % (qtname, confirmed, transient))
+    extra.update({'confirmed': confirmed, 'transient': transient})
+    if qtname in DIFF_LOG.stopped:
+        extra['stopped_at_limit'] = True
+    configure['compare_info'][qtname] = (status, info[1], info[2], info[3], extra)
+    return status, result[1], result[2]
+
+
+def mode_comparison(srcColl, dstColl, mode, check_latest_size, full_check_size, check_perc, qtname):
+    # data_comparison按对比模式分派
+    src_meta = get_meta(srcColl)
     if mode == "no":
-        configure['compare_info'][qtname] = (True, srcColl.count(), 0, 0)
+        configure['compare_info'][qtname] = (True, src_meta.count, 0, 0)
         return True, 0, 0
+    elif mode in ("all", "hash"):
+        # 全量对比走归并对比，同时能发现仅目标端存在的文档; hash模式只对摘要不同的范围做归并对比
+        start = int(time.time())
+        if mode == "hash":
+            stat = hash_comparison(srcColl, dstColl, qtname, src_meta.count, start)
+        elif configure[SHARD_DIRECT]:
+            stat = shard_comparison(srcColl, dstColl, qtname, src_meta.count, start)
+        else:
+            stat = ranged_merge_join(srcColl, dstColl, qtname, src_meta.count, start)
+        status = stat['src_only'] == 0 and stat['dst_only'] == 0 and stat['diff'] == 0
+        extra = dict((k, v) for k, v in stat.items() if k != 'checked')
+        configure['compare_info'][qtname] = (status, src_meta.count, stat['checked'], int(time.time()) - start, extra)
+        return status, stat['checked'], int(time.time()) - start
     elif mode == "sample":
         # srcColl.count() mus::t equals to dstColl.count()
-        count = configure[COMPARISION_COUNT] if configure[COMPARISION_COUNT] <= srcColl.count() else srcColl.count()
+        count = configure[COMPARISION_COUNT] if configure[COMPARISION_COUNT] <= src_meta.count else src_meta.count
         if 0 < check_perc <= 100:
-            count = int(srcColl.count() * (check_perc / 100))
-    else:  # all
-        count = srcColl.count()
+            count = int(src_meta.count * (check_perc / 100))
+        if configure[CONFIDENCE] > 0:
+            # 按置信度和可容忍的不一致比例算样本数，代替--count/--check-perc，样本数达到总行数时才全量对比
+            count = sample_size(src_meta.count, configure[CONFIDENCE], configure[MISMATCH_RATE])
+            full_check_size = count + 1 if count >= src_meta.count else 0
 
     if count == 0:
-        configure['compare_info'][qtname] = (True, srcColl.count(), 0, 0)
+        configure['compare_info'][qtname] = (True, src_meta.count, 0, 0)
         return True, 0, 0
 
-    global SRC_VERSION
+    with inflight(srcColl, dstColl):
+        return sample_comparison(srcColl, dstColl, src_meta, count, check_latest_size, full_check_size, qtname)
+
+
+def sample_comparison(srcColl, dstColl, src_meta, count, check_latest_size, full_check_size, qtname):
+    '''
+    采样对比，参数同data_comparison
+    :param src_meta: 源端集合元数据
+    :param count: 要对比的行数
+    '''
     rec_count = count
-    batch = configure[BATCH_SIZE]
-    # 经测试，每批次对比在20-50之间效果好，这里进行了限制
-    if configure[BATCH_SIZE] > 50:
-        configure[BATCH_SIZE] = 50
-    if configure[BATCH_SIZE] < 20:
-        configure[BATCH_SIZE] = 20
+    # 批大小按每批耗时自适应调整，--batch-size为初始值
+    controller = BatchController(srcColl, configure[BATCH_SIZE], src_meta.avg_obj_size)
+    # 样本数小于一批时(如按置信度算出的样本数很小)一批就取完
+    batch = max(min(controller.current(), count), 1)
     large_skip_max = 10000
     show_progress = (batch * 25)
     total = 0
     # batch size
-    size = int(count / batch)
+    size = max(int(count / batch), 1)
     # step factor
-    step_factor = int(srcColl.count() / count)
+    step_factor = max(int(src_meta.count / count), 1)
     skip_step_rows = batch * step_factor
     if skip_step_rows > large_skip_max:
         # skip factor , improve skip efficiency
-        size = int(srcColl.count() / large_skip_max)
+        size = max(int(src_meta.count / large_skip_max), 1)
         # batch factor
         batch = int(math.ceil(count / size)) + 1
         skip_step_rows = large_skip_max
     log_info("[%s],total:%s,size:%s,step_factor:%s,skip_step_rows:%s,batch:%s" % (qtname, total, size, step_factor, skip_step_rows, batch))
+    # 不一致文档的id_key，$sample多次取到同一个文档时只算一次
+    mismatched = {'src_only': set(), 'diff': set()}
+
+    def found(missing, diff):
+        # 记下不一致的文档，达到--max-mismatches时不再继续对比这个集合；进程池对比时diff是(_id, 不一致的字段)
+        mismatched['src_only'].update(id_key(_id) for _id in missing)
+        mismatched['diff'].update(id_key(item[0] if process_pool() is not None else doc_id(item[0])) for item in diff)
+        if DIFF_LOG.full(qtname):
+            DIFF_LOG.stop(qtname)
+            return True
+        return False
+
+    # 进程池模式下各批对比不等结果，取样读取和进程池对比并行
+    pipeline = BatchPipeline(dstColl, qtname)
+
+    def compare_docs(docs):
+        # 提交一批文档对比，处理已经对比完的批，返回是否达到--max-mismatches
+        return any([found(missing, diff) for missing, diff in pipeline.submit(docs) if missing or diff])
+
+    def finish(checked):
+        # 等待在途的批，记录compare_info并返回对比结果，有不一致时附上不一致的行数，否则附上置信上界
+        for missing, diff in pipeline.drain():
+            if missing or diff:
+                found(missing, diff)
+        status = not mismatched['src_only'] and not mismatched['diff']
+        extra = confidence_extra(checked, src_meta.count) if status else dict((k, len(v)) for k, v in mismatched.items())
+        configure['compare_info'][qtname] = (status, src_meta.count, checked, int(time.time()) - start, extra)
+        return status, checked, int(time.time()) - start
 
     start = int(time.time())
     # 对比最新的n行数据
     if check_latest_size > 0:
-        docs = srcColl.find({}).sort([("_id", -1)]).limit(check_latest_size)
+        docs = MeteredCursor(doc_coll(srcColl).find({}, projection(srcColl)).sort([("_id", -1)]).limit(check_latest_size), src_meta.avg_obj_size, 'fetch', 'src')
         checked_row_count = 0
-        for doc in docs:
-            migrated = dstColl.find_one(doc["_id"])
-            # both origin and migrated bson is Map . so use ==
-            checked_row_count += 1
-            if doc != migrated:
-                log_error("DIFF => [%s] src_record[%s], dst_record[%s]" % (qtname, doc, migrated))
-                configure['compare_info'][qtname] = (False, srcColl.count(), checked_row_count, int(time.time()) - start)
-                return False, checked_row_count, int(time.time()) - start
+        batch_start = time.time()
+        for batch_docs in iter_batches(docs, controller.current):
+            checked_row_count += len(batch_docs)
+            METRICS.add(qtname, **docs.flush())
+            if compare_docs(batch_docs):
+                return finish(checked_row_count)
+            controller.observe(len(batch_docs), time.time() - batch_start)
+            batch_start = time.time()
 
     # 集合没有超过对比行数的最小值则全量对比
     if count < full_check_size:
-        docs = srcColl.find({})
+        docs = MeteredCursor(doc_coll(srcColl).find({}, projection(srcColl)), src_meta.avg_obj_size, 'fetch', 'src')
         checked_row_count = 0
-        for doc in docs:
-            migrated = dstColl.find_one(doc["_id"])
-            checked_row_count += 1
-            # both origin and migrated bson is Map . so use ==
-            if doc != migrated:
-                log_error("DIFF => [%s] src_record[%s], dst_record[%s]" % (qtname, doc, migrated))
-                configure['compare_info'][qtname] = (False, srcColl.count(), checked_row_count, int(time.time()) - start)
-                return False, checked_row_count, int(time.time()) - start
-        configure['compare_info'][qtname] = (True, total, checked_row_count, int(time.time()) - start)
-        return True, total, int(time.time()) - start
+        batch_start = time.time()
+        for batch_docs in iter_batches(docs, controller.current):
+            checked_row_count += len(batch_docs)
+            METRICS.add(qtname, **docs.flush())
+            if compare_docs(batch_docs):
+                return finish(checked_row_count)
+            controller.observe(len(batch_docs), time.time() - batch_start)
+            batch_start = time.time()
+        return finish(checked_row_count)
 
+    # 低版本没有$sample，_id类型支持时沿着_id索引随机定位取样
+    sampler = None if src_meta.version >= configure[SS] else id_sampler(srcColl)
+    # 按置信度定样本数时分层抽样，样本在各_id范围内均匀
+    strata, draws, spread = None, 0, False
+    if configure[CONFIDENCE] > 0 and (src_meta.version >= configure[SS] or sampler is not None):
+        strata = Strata([upper for _, upper in split_id_ranges(srcColl, configure[SAMPLE_STRATA])[:-1]], count)
+    # 低版本已经对比过的文档的id_key，退回skip取样时重复的文档不再计入检查行数
+    compared = set()
     while count > 0:
         # 高版本对比，原版的对比方法
-        if SRC_VERSION >= configure[SS]:
-            docs = srcColl.aggregate([{"$sample": {"size": batch}}])
-            checked_row_count = 0
-            while docs.alive:
-                doc = docs.next()
-                migrated = dstColl.find_one(doc["_id"])
-                checked_row_count += 1
-                # both origin and migrated bson is Map . so use ==
-                if doc != migrated:
-                    log_error("DIFF => [%s] src_record[%s], dst_record[%s]" % (qtname, doc, migrated))
-                    configure['compare_info'][qtname] = (False, srcColl.count(), total + checked_row_count, int(time.time()) - start)
-                    return False, total + checked_row_count, int(time.time()) - start
-            total += batch
-            count -= batch
-
-            if total % show_progress == 0:
+        if src_meta.version >= configure[SS] or sampler is not None:
+            n = min(controller.current(), count)
+            batch_start = time.time()
+            if sampler is None:
+                docs = list(doc_coll(srcColl).aggregate([{"$sample": {"size": n}}] + ([{"$project": projection(srcColl)}] if projection(srcColl) else [])))
+            else:
+                docs = seek_sample(srcColl, sampler, n)
+            METRICS.add(qtname, fetch=time.time() - batch_start, src_bytes=docs_size(docs, src_meta.avg_obj_size))
+            if sampler is not None and len(docs) < n / 2.0:
+                # 插值的_id大多落在空档里，定位到同一批文档上(如ObjectId按时间成批写入)
+                if not spread:
+                    log_info("[%s] seek sample got %d of %d docs, seek within _id ranges" % (qtname, len(docs), n))
+                    sampler = id_sampler(srcColl, [upper for _, upper in split_id_ranges(srcColl, configure[SAMPLE_STRATA])[:-1]])
+                    spread = True
+                else:
+                    log_info("[%s] seek sample got %d of %d docs, use skip sample" % (qtname, len(docs), n))
+                    sampler = None
+            n = len(docs)
+            if n == 0 and sampler is None and src_meta.version >= configure[SS]:
+                log_info(" [%s] $sample returned no docs, %d samples left" % (qtname, count))
+                break
+            if strata is not None:
+                draws += len(docs)
+                docs = strata.accept(docs)
+                n = len(docs)
+            if compare_docs(docs):
+                return finish(total + len(docs))
+            if src_meta.version < configure[SS]:
+                compared.update(id_key(doc_id(doc)) for doc in docs)
+            controller.observe(len(docs), time.time() - batch_start)
+            total += n
+            count -= n
+            if strata is not None and draws > rec_count * 5:
+                # 某些层一直取不到样本(取样分布不均)，按已经对比的样本报告置信度
+                log_info(" [%s] stratified sampling stopped after %d draws, %d samples left" % (qtname, draws, count))
+                count = 0
+
+            if int(total / show_progress) != int((total - n) / show_progress):
                 log_info(" [%s] ... process %d docs, %.2f %% !" % (qtname, total, total * 100.0 / rec_count))
         else:
-            # 低版本的对比方法 主要改进的地方
+            # 低版本的对比方法 主要改进的地方，_id类型无法插值取样时使用
             last_id = 0
-            checked_row_count = 0
             is_over_num = 0
             for j in range(size):
                 condition = {} if last_id == 0 else {"_id": {"$gte": last_id}}
                 # docs = srcColl.find(condition).sort([("_id", 1)]).skip(j if j == 0 else skip_step_rows).limit(batch)
-                docs = srcColl.find(condition).skip(j if j == 0 else skip_step_rows).limit(batch)
-                for doc in docs:
+                batch_start = time.time()
+                docs = list(doc_coll(srcColl).find(condition, projection(srcColl)).skip(j if j == 0 else skip_step_rows).limit(batch))
+                METRICS.add(qtname, fetch=time.time() - batch_start, src_bytes=docs_size(docs, src_meta.avg_obj_size))
+                n = 0
+                if docs:
                     is_over_num = j
-                    migrated = dstColl.find_one(doc["_id"])
-                    checked_row_count += 1
-                    # both origin and migrated bson is Map . so use ==
-                    if doc != migrated:
-                        log_error("DIFF => [%s] src_record[%s], dst_record[%s]" % (qtname, doc, migrated))
-                        configure['compare_info'][qtname] = (False, srcColl.count(), checked_row_count, int(time.time()) - start)
-                        return False, checked_row_count, int(time.time()) - start
-                    last_id = doc['_id']
+                    keys = set(id_key(doc_id(doc)) for doc in docs) - compared
+                    compared.update(keys)
+                    n = len(keys)
+                    if compare_docs(docs):
+                        return finish(total + n)
+                    last_id = doc_id(docs[-1])
+                    # 跳跃步长按批大小算好了，这里批大小固定，只做退避和限速
+                    controller.observe(len(docs), time.time() - batch_start)
                 if is_over_num != j:
-                    count = -1
                     break
-                total += batch
-                count -= batch
-                if total % show_progress == 0:
+                total += n
+                count -= n
+                if int(total / show_progress) != int((total - n) / show_progress):
                     log_info(" [%s] ... process %d docs, %.2f %% !" % (qtname, total, total * 100.0 / rec_count))
-    configure['compare_info'][qtname] = (True, srcColl.count(), total, int(time.time()) - start)
-    return True, total, int(time.time()) - start
+            # 只扫描一遍，再从头扫描只会重复对比同样的文档；样本不足时按实际对比的行数报告
+            if count > 0:
+                log_info(" [%s] skip sample scanned the collection once, %d samples left" % (qtname, count))
+            count = -1
+    log_info("[%s] batch size %d, %.0f docs/s" % (qtname, controller.current(), controller.throughput()))
+    return finish(total)
+
+
+def ns_included(ns):
+    # 跟踪到的变更是否属于要对比的库和集合
+    db, _, coll = ns.partition('.')
+    if db in configure[EXCLUDE_DBS] or coll in configure[EXCLUDE_COLLS] or coll.startswith('system.'):
+        return False
+    return len(configure[INCLUDE_DBS]) == 0 or db in configure[INCLUDE_DBS]
+
+
+class Follower(object):
+    '''
+    --follow模式: 持续跟踪源端的写入，4.0及以上用集群级的change stream，低版本tail oplog，
+    变更的_id去重后等待--follow-lag秒(给同步留出延迟)，再按批到两端复查，开销随写入量增长而不是数据量
+    '''
+
+    def __init__(self, src, dst):
+        self.src, self.dst = src, dst
+        self.lock = Lock()
+        # (namespace, id_key) -> [_id, 第一次变更时间, 最后一次变更时间]
+        self.pending = {}
+        self.stat = {}
+        self.stop = Event()
+        self.use_stream = server_version(src) >= 40
+        self.stream, self.resume_token, self.oplog_ts = None, None, None
+        self.thread = Thread(target=contextvars.copy_context().run, args=(self.tail,))
+        self.thread.daemon = True
+
+    def start(self):
+        # 在初始对比之前开始跟踪，初始对比期间的写入也会被复查
+        if self.use_stream:
+            self.stream = self.src.watch(max_await_time_ms=1000)
+        else:
+            last = next(self.src.local['oplog.rs'].find({}, {'ts': 1}).sort([('$natural', -1)]).limit(1), None)
+            self.oplog_ts = last['ts'] if last else Timestamp(int(time.time()), 0)
+        self.thread.start()
+
+    def add(self, ns, _id):
+        if not ns_included(ns):
+            return
+        key, now = (ns, id_key(_id)), time.time()
+        with self.lock:
+            if key in self.pending:
+                self.pending[key][2] = now
+            else:
+                self.pending[key] = [_id, now, now]
+
+    def tail(self):
+        while not self.stop.is_set():
+            try:
+                if self.use_stream:
+                    self.tail_stream()
+                else:
+                    self.tail_oplog()
+            except pymongo.errors.PyMongoError as e:
+                log_error("follow tail failed: %r, retry" % e)
+                self.stream = None
+                self.stop.wait(1)
+
+    def tail_stream(self):
+        if self.stream is None:
+            self.stream = self.src.watch(max_await_time_ms=1000, resume_after=self.resume_token)
+        while not self.stop.is_set():
+            change = self.stream.try_next()
+            if change is None:
+                continue
+            self.resume_token = self.stream.resume_token
+            if 'documentKey' in change and 'ns' in change:
+                self.add('%s.%s' % (change['ns']['db'], change['ns'].get('coll')), change['documentKey']['_id'])
+
+    def tail_oplog(self):
+        cursor = self.src.local['oplog.rs'].find({'ts': {'$gt': self.oplog_ts}, 'op': {'$in': ['i', 'u', 'd']}},
+                                                 cursor_type=pymongo.CursorType.TAILABLE_AWAIT, oplog_replay=True)
+        while cursor.alive and not self.stop.is_set():
+            for entry in cursor:
+                self.oplog_ts = entry['ts']
+                doc = entry.get('o2') if entry['op'] == 'u' else entry.get('o')
+                if doc and '_id' in doc:
+                    self.add(entry['ns'], doc['_id'])
+                if self.stop.is_set():
+                    break
+        if not cursor.alive:
+            # 游标已失效(如空闲的源端上初次查询没有匹配的oplog)，等一下再重新查询，不要空转
+            self.stop.wait(1)
+
+    def ready(self, lag):
+        # 最后一次变更已超过lag秒的_id，一直在变的热点文档最多推迟10倍lag
+        now, ready = time.time(), {}
+        with self.lock:
+            for key, (_id, first, last) in list(self.pending.items()):
+                if now - last >= lag or now - first >= lag * 10:
+                    ready.setdefault(key[0], []).append(_id)
+                    del self.pending[key]
+        return ready
+
+    def recheck(self, ns, ids):
+        db, coll = ns.split('.', 1)
+        stat = self.stat.setdefault(ns, {'checked': 0, 'src_only': 0, 'dst_only': 0, 'diff': 0})
+        prepare_projection(self.src[db][coll], self.dst[db][coll])
+        for batch in iter_batches(ids, configure[CURSOR_BATCH]):
+            keys = [{'_id': _id} for _id in batch]
+            src_docs, dst_docs = lookup_batch(self.src[db][coll], keys), lookup_batch(self.dst[db][coll], keys)
+            throttle(len(src_docs), len(src_docs) * get_meta(self.src[db][coll]).avg_obj_size)
+            for _id in batch:
+                src_doc, dst_doc = src_docs.get(id_key(_id)), dst_docs.get(id_key(_id))
+                stat['checked'] += 1
+                if src_doc is None and dst_doc is None:
+                    continue
+                if dst_doc is None:
+                    log_error("DIFF => [%s] src_record _id[%r] not exists in dst" % (ns, _id))
+                    DIFF_LOG.write(ns, 'src_only', _id, phase='follow')
+                    stat['src_only'] += 1
+                elif src_doc is None:
+                    log_error("DIFF => [%s] dst_record _id[%r] not exists in src" % (ns, _id))
+                    DIFF_LOG.write(ns, 'dst_only', _id, phase='follow')
+                    stat['dst_only'] += 1
+                elif not docs_equal(src_doc, dst_doc):
+                    log_error(diff_report(ns, src_doc, dst_doc))
+                    DIFF_LOG.write(ns, 'diff', _id, doc_diff(to_dict(src_doc), to_dict(dst_doc)), phase='follow')
+                    stat['diff'] += 1
+
+    def report(self):
+        with self.lock:
+            pending = len(self.pending)
+        log_info('follow info, pending changes: %d\n----------------------------------------' % pending)
+        for ns in sorted(self.stat):
+            stat = self.stat[ns]
+            ok = stat['src_only'] == 0 and stat['dst_only'] == 0 and stat['diff'] == 0
+            print('%s [%s],recheck=%d, src_only:%d, dst_only:%d, diff:%d' % ('===' if ok else 'XXX', ns, stat['checked'],
+                                                                           stat['src_only'], stat['dst_only'], stat['diff']))
+
+    def run(self):
+        # 初始对比结束后循环复查，直到--follow-duration秒或者Ctrl-C
+        lag = configure[FOLLOW_LAG]
+        log_info("follow mode, tail %s, recheck changes after %ss" % ('change stream' if self.use_stream else 'oplog', lag))
+        deadline = time.time() + configure[FOLLOW_DURATION] if configure[FOLLOW_DURATION] > 0 else None
+        last_report = time.time()
+        try:
+            while deadline is None or time.time() < deadline:
+                ready = self.ready(lag)
+                for ns, ids in ready.items():
+                    self.recheck(ns, ids)
+                if time.time() - last_report >= 60:
+                    self.report()
+                    last_report = time.time()
+                if not ready:
+                    self.stop.wait(1)
+        except KeyboardInterrupt:
+            log_info("follow mode interrupted")
+        self.stop.set()
+        self.report()
+
+    def close(self):
+        # 停止跟踪线程并关闭change stream，要在关闭连接之前调用，初始对比出错时跟踪线程也要停下来
+        self.stop.set()
+        if self.thread.is_alive():
+            # try_next和tailable游标的getMore最多在服务端等待1秒
+            self.thread.join(10)
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
 
 
 def usage():
@@ -366,26 +2382,128 @@ def usage():
 --latest-size=0 (检查最新的n行数据，默认为0) \\
 --full-less-than=1000 (抽样对比数据的最小行数，低于此值则全量对比)  \\
 --threads=1  (指定要对比数据使用的线程数，默认单线程)\\
---batch-size=20 (每批对比多少行数据，默认30 范围20-50)  \\
+--batch-size=30 (每批对比多少行数据的初始值，默认30，之后按每批耗时自适应调整)  \\
+--batch-min=20 --batch-max=1000 (自适应调整时每批行数的范围)  \\
+--batch-target-ms=200 (每批对比的目标耗时(毫秒)，低于此值放大批次，超过2倍时减半)  \\
+--max-ops=0 --max-bytes=0 (限制每秒从源端读取的文档数和字节数，默认0不限制；源端读命令耗时明显升高时也会自动退避)  \\
+--report-json='' --report-prom='' (结束时导出性能统计的json报告和prometheus textfile：每个集合的每秒行数、读取字节数、各阶段耗时和两端往返耗时直方图)  \\
+--report-interval=0 (每隔多少秒导出一次快照，默认0只在结束时导出)  \\
+--cursor-batch=1000 (全量对比(--comparison-mode=all)时源端和目标端游标每批取回的行数，默认1000)  \\
+--split-threshold=1000000 (全量对比时行数超过此值的集合按_id范围切分后并发对比)  \\
+--split-ranges=16 (大集合切分的_id范围个数)  \\
+--range-threads=0 (各_id范围共用的对比线程数，默认和--threads相同，为1时不切分)  \\
+--exact-count=False (是否用count_documents精确统计行数，默认用collStats中的行数，不扫描集合)  \\
+--max-inflight=0 (每个集群同时执行的对比任务数上限，默认0不限制)  \\
+--checkpoint=''  (断点文件路径，记录已完成的集合和全量对比时各_id范围的进度)  \\
+--resume=False  (从--checkpoint指定的断点文件继续，跳过已完成的集合)  \\
+--follow=False  (初始对比后持续跟踪源端的写入(4.0+用change stream，低版本用oplog)，只复查变更过的文档)  \\
+--follow-lag=10  (变更后等待多少秒再复查，留给同步的延迟)  \\
+--follow-duration=0  (跟踪多少秒后退出，默认0一直跟踪到Ctrl-C)  \\
+--raw-bson=False  (文档不解码，直接比较原始bson字节，字节不同时才解码做字段级对比，大文档时节省CPU)  \\
+--processes=0  (解码和对比文档使用的进程数，默认0在对比线程中进行，指定时自动启用--raw-bson)  \\
+--fields='db1.coll1:a,b.c;db2.*:x' (只对比指定的字段，按namespace配置，namespace可以是db.coll、db.*或*，两端读取时作为投影发给服务端)  \\
+--ignore-fields='*:updatedAt;db1.coll1:blob' (不对比的字段，例如同步工具写入时会改写的时间戳)  \\
+--confidence=0 --max-mismatch-rate=0.001 (sample模式按置信度定样本数，如0.99表示99%置信度下不一致比例不超过0.1%，代替--count/--check-perc，汇总中报告达到的上界)  \\
+--sample-strata=16 (按置信度抽样时把_id分成多少层，各层样本数相同)  \\
+--max-mismatches=1000 (每个集合最多记录多少个不一致的文档，达到后sample模式停止对比这个集合，为0时遇到第一批不一致就停止)  \\
+--diff-file='' (不一致的文档流式写入此文件，.bson结尾时写bson，否则每行一个json)  \\
+--recheck-delay=0 (集合对比完后等待多少秒复查不一致的_id，区分同步延迟造成的暂时不一致，默认0不复查)  \\
+--hash-fields='db1.coll1:blob' (和--fields一起使用，这些字段在服务端用$toHashedIndexKey算成hash后传输和对比，需要4.4+，大字段不再经过网络)  \\
+--shard-direct=False  (源端为分片集群时，全量对比按config.chunks直接连接各分片并发读取(优先secondary)，分片上需要有和--src同名的用户)  \\
 --sample-version=40 (指定mongodb版本为多少时使用sample函数，默认4.0.x使用collection.aggregate([{"$sample": {"size": xx}}])函数取数据对比，则这里要填写40，低于此版本用find().limit()取函数对比 建议调大此参数)   \\
---comparison-mode=sample/all/no (sample: 采样检查 默认, all: 全量对比; no: 仅对比总行数和索引量)""")
+--hash-leaf-size=10000 (hash模式下每个桶的行数，摘要不一致的桶逐条对比)  \\
+--hash-fanout=16 (hash模式下一次聚合计算摘要的桶数)  \\
+--comparison-mode=sample/all/hash/no (sample: 采样检查 默认, all: 全量对比，两端按_id排序归并对比，能发现仅目标端存在的文档;
+                                     hash: 两端按_id分桶在服务端计算摘要，只逐条对比摘要不一致的桶，数据基本一致时传输量最小; no: 仅对比总行数和索引量)""")
     print()
 
 
+def parse_ns_fields(value):
+    '''
+    解析按namespace配置的字段列表，格式: db.coll:a,b.c;db.*:x;*:y
+    :return: dict namespace -> 字段列表，_id总是要对比的，不在列表中
+    '''
+    fields = {}
+    for item in value.split(';'):
+        if not item.strip():
+            continue
+        ns, _, names = item.strip().rpartition(':')
+        fields[ns or '*'] = [name.strip() for name in names.split(',') if name.strip() and name.strip() != '_id']
+    return fields
+
+
+def default_options():
+    # 各配置项的默认值，命令行参数和Comparator的options在此基础上覆盖
+    return {SAMPLE: True, COMPARISION_MODE: 'sample', COMPARISION_COUNT: 10000,
+            EXCLUDE_DBS: [], EXCLUDE_COLLS: [], INCLUDE_DBS: [], CONTINUE: False,
+            LATEST_SIZE: 0, FULL_CHECK_SIZE: 1000, CHECK_PERC: 0,
+            THREADS: 1, BATCH_SIZE: 30, SS: 40, CURSOR_BATCH: 1000,
+            SPLIT_THRESHOLD: 1000000, SPLIT_RANGES: 16, RANGE_THREADS: 0,
+            HASH_LEAF_SIZE: 10000, HASH_FANOUT: 16, EXACT_COUNT: False, MAX_INFLIGHT: 0,
+            CHECKPOINT_FILE: '', RESUME: False, FOLLOW: False, FOLLOW_LAG: 10, FOLLOW_DURATION: 0,
+            RAW_BSON: False, PROCESSES: 0, BATCH_MIN: 20, BATCH_MAX: 1000, BATCH_TARGET_MS: 200,
+            MAX_OPS: 0, MAX_BYTES: 0, REPORT_JSON: '', REPORT_PROM: '', REPORT_INTERVAL: 0,
+            SHARD_DIRECT: False, FIELDS: {}, IGNORE_FIELDS: {}, HASH_FIELDS: {},
+            CONFIDENCE: 0, MISMATCH_RATE: 0.001, SAMPLE_STRATA: 16,
+            DIFF_FILE: '', MAX_MISMATCHES: 1000, RECHECK_DELAY: 0}
+
+
+def normalize_options(options):
+    '''
+    补全由其他配置项决定的配置并检查配置之间的冲突，命令行参数和Comparator的options都经过这里
+    :param options: 配置dict，原地修改
+    :return: options
+    :raise ValueError: 配置不合法
+    '''
+    if options[COMPARISION_MODE] not in ("all", "no", "sample", "hash"):
+        raise ValueError("comparisonMode[%r] illegal" % options[COMPARISION_MODE])
+    if options[RANGE_THREADS] <= 0:
+        options[RANGE_THREADS] = options[THREADS]
+    if options[PROCESSES] > 0:
+        # 进程池直接处理原始bson
+        options[RAW_BSON] = True
+    # hash模式的桶、每次聚合的桶数、批大小、分层数至少为1
+    options[HASH_FANOUT] = max(options[HASH_FANOUT], 1)
+    options[HASH_LEAF_SIZE] = max(options[HASH_LEAF_SIZE], 1)
+    options[BATCH_MIN] = max(options[BATCH_MIN], 1)
+    options[BATCH_MAX] = max(options[BATCH_MAX], options[BATCH_MIN])
+    options[MAX_MISMATCHES] = max(options[MAX_MISMATCHES], 0)
+    options[SAMPLE_STRATA] = max(options[SAMPLE_STRATA], 1)
+    if not 0 <= options[CONFIDENCE] < 1 or not 0 < options[MISMATCH_RATE] < 1:
+        raise ValueError("--confidence should be in [0, 1) and --max-mismatch-rate in (0, 1)")
+    for ns in options[HASH_FIELDS]:
+        if not ns_fields(FIELDS, ns, options):
+            raise ValueError("--hash-fields of [%s] needs --fields, find projection can not mix computed fields with the rest of the document" % ns)
+    if options[RESUME] and not options[CHECKPOINT_FILE]:
+        raise ValueError("--resume needs --checkpoint")
+
+    # default count is 10000
+    if options.get(COMPARISION_COUNT) is None or options.get(COMPARISION_COUNT) <= 0:
+        options[COMPARISION_COUNT] = 10000
+
+    # ignore databases
+    options[EXCLUDE_DBS] = options[EXCLUDE_DBS] + [db for db in ["admin", "local", "test"] if db not in options[EXCLUDE_DBS]]
+    options[EXCLUDE_COLLS] = options[EXCLUDE_COLLS] + [coll for coll in ["system.profile"] if coll not in options[EXCLUDE_COLLS]]
+    return options
+
+
 def parse_args():
+    '''
+    解析命令行参数
+    :return: (源端连接串, 目标端连接串, 配置dict)
+    '''
     opts, args = getopt.getopt(sys.argv[1:], "hs:d:n:e:x:i:c:ls:fl:cp:t:b:ss:",
                                ["help", "src=", "dest=", "count=", "exclude-dbs=", "exclude-collections=", "comparison-mode=", 'include-dbs=', 'continue=',
-                                'latest-size=', 'full-less-than=', 'check-perc=', 'threads=', "batch-size=", 'sample-version='])
-
-    configure[SAMPLE] = True
-    configure[EXCLUDE_DBS] = []
-    configure[EXCLUDE_COLLS] = []
-    configure[INCLUDE_DBS] = []
-    configure[CONTINUE] = False
-    configure[LATEST_SIZE], configure[FULL_CHECK_SIZE], configure[CHECK_PERC] = 0, 1000, 0
-    configure[THREADS] = 1
-    configure[BATCH_SIZE] = 30
-    configure[SS] = 40
+                                'latest-size=', 'full-less-than=', 'check-perc=', 'threads=', "batch-size=", 'sample-version=',
+                                'cursor-batch=', 'split-threshold=', 'split-ranges=', 'range-threads=',
+                                'hash-leaf-size=', 'hash-fanout=', 'exact-count=', 'max-inflight=',
+                                'checkpoint=', 'resume=', 'follow=', 'follow-lag=', 'follow-duration=',
+                                'raw-bson=', 'processes=', 'batch-min=', 'batch-max=', 'batch-target-ms=',
+                                'max-ops=', 'max-bytes=', 'report-json=', 'report-prom=', 'report-interval=',
+                                'shard-direct=', 'fields=', 'ignore-fields=', 'hash-fields=',
+                                'confidence=', 'max-mismatch-rate=', 'sample-strata=', 'max-mismatches=', 'diff-file=', 'recheck-delay='])
+
+    configure = default_options()
     srcUrl, dstUrl = "", ""
 
     for key, value in opts:
@@ -417,42 +2535,131 @@ def parse_args():
             configure[BATCH_SIZE] = int(value)
         if key in ("-ss", '--sample-version'):
             configure[SS] = int(value)
+        if key == '--cursor-batch':
+            configure[CURSOR_BATCH] = int(value)
+        if key == '--split-threshold':
+            configure[SPLIT_THRESHOLD] = int(value)
+        if key == '--split-ranges':
+            configure[SPLIT_RANGES] = int(value)
+        if key == '--range-threads':
+            configure[RANGE_THREADS] = int(value)
+        if key == '--hash-leaf-size':
+            configure[HASH_LEAF_SIZE] = int(value)
+        if key == '--hash-fanout':
+            configure[HASH_FANOUT] = int(value)
+        if key == '--exact-count':
+            configure[EXACT_COUNT] = str(value).lower() == 'true'
+        if key == '--max-inflight':
+            configure[MAX_INFLIGHT] = int(value)
+        if key == '--checkpoint':
+            configure[CHECKPOINT_FILE] = value
+        if key == '--resume':
+            configure[RESUME] = str(value).lower() == 'true'
+        if key == '--follow':
+            configure[FOLLOW] = str(value).lower() == 'true'
+        if key == '--follow-lag':
+            configure[FOLLOW_LAG] = float(value)
+        if key == '--follow-duration':
+            configure[FOLLOW_DURATION] = float(value)
+        if key == '--raw-bson':
+            configure[RAW_BSON] = str(value).lower() == 'true'
+        if key == '--processes':
+            configure[PROCESSES] = int(value)
+        if key == '--batch-min':
+            configure[BATCH_MIN] = int(value)
+        if key == '--batch-max':
+            configure[BATCH_MAX] = int(value)
+        if key == '--batch-target-ms':
+            configure[BATCH_TARGET_MS] = float(value)
+        if key == '--max-ops':
+            configure[MAX_OPS] = float(value)
+        if key == '--max-bytes':
+            configure[MAX_BYTES] = float(value)
+        if key == '--report-json':
+            configure[REPORT_JSON] = value
+        if key == '--report-prom':
+            configure[REPORT_PROM] = value
+        if key == '--report-interval':
+            configure[REPORT_INTERVAL] = float(value)
+        if key == '--shard-direct':
+            configure[SHARD_DIRECT] = str(value).lower() == 'true'
+        if key == '--max-mismatches':
+            configure[MAX_MISMATCHES] = int(value)
+        if key == '--diff-file':
+            configure[DIFF_FILE] = value
+        if key == '--recheck-delay':
+            configure[RECHECK_DELAY] = float(value)
+        if key == '--confidence':
+            configure[CONFIDENCE] = float(value)
+        if key == '--max-mismatch-rate':
+            configure[MISMATCH_RATE] = float(value)
+        if key == '--sample-strata':
+            configure[SAMPLE_STRATA] = int(value)
+        if key in ('--fields', '--ignore-fields', '--hash-fields'):
+            configure[{'--fields': FIELDS, '--ignore-fields': IGNORE_FIELDS, '--hash-fields': HASH_FIELDS}[key]] = parse_ns_fields(value)
         if key in ("--comparison-mode"):
-            if value != "all" and value != "no" and value != "sample":
+            if value not in ("all", "no", "sample", "hash"):
                 log_info("comparisonMode[%r] illegal" % (value))
                 sys.exit()
             configure[COMPARISION_MODE] = value
-    if COMPARISION_MODE not in configure:
-        configure[COMPARISION_MODE] = "sample"
+    try:
+        normalize_options(configure)
+    except ValueError as e:
+        log_error(e)
+        sys.exit()
 
     # params verify
     if len(srcUrl) == 0 or len(dstUrl) == 0:
         usage()
         sys.exit()
 
-    # default count is 10000
-    if configure.get(COMPARISION_COUNT) is None or configure.get(COMPARISION_COUNT) <= 0:
-        configure[COMPARISION_COUNT] = 10000
-
-    # ignore databases
-    configure[EXCLUDE_DBS] += ["admin", "local", "test"]
-    configure[EXCLUDE_COLLS] += ["system.profile"]
-
     # dump configuration
     log_info(
         "Configuration [sample=%s, count=%d, exclude-dbs=%s, exclude-colls=%s, include-dbs=%s,continue={}, latest_size=%d, full_check_less_than=%d, check_perc=%d ,threads=%s, batchsize=%d, sample-skip=%d]".format(
             configure[CONTINUE]) % (
             configure[SAMPLE], configure[COMPARISION_COUNT], configure[EXCLUDE_DBS], configure[EXCLUDE_COLLS], configure[INCLUDE_DBS],
             configure[LATEST_SIZE], configure[FULL_CHECK_SIZE], configure[CHECK_PERC], configure[THREADS], configure[BATCH_SIZE], configure[SS]))
-    return srcUrl, dstUrl
+    return srcUrl, dstUrl, configure
+
+
+def merged_result(qtname):
+    # 多线程对比时，把数据对比结果compare_info合并到check()生成的汇总行中
+    com_info = configure['compare_info'].get(qtname)
+    tmp = configure['compare_result'][qtname]
+    if not com_info[0] and tmp.startswith('==='):
+        tmp = 'XXX' + tmp[3:]
+    add_info = "Data comparison results: {}/{}, Percentage of inspection:{}%, Time consuming:{}s".format(com_info[2], com_info[1],
+                                                                                                         round(
+                                                                                                             (com_info[2] / com_info[1] if com_info[
+                                                                                                                                               1] != 0 else 1) * 100,
+                                                                                                             3), com_info[3]) + compare_info_extra(qtname)
+    return tmp + ",datacompare={} ({})".format('ok' if com_info[0] else 'err', add_info)
+
 
+def job_done(qtname, result, error):
+    # 调度器中一个集合对比完成: 异常记为对比失败，成功的写入断点文件
+    if error is not None:
+        info = configure['compare_info'].get(qtname) or (False, 0, 0, 0)
+        configure['compare_info'][qtname] = (False, info[1], info[2], info[3], {'error': repr(error)})
+    elif CHECKPOINT:
+        configure['compare_result'][qtname] = merged_result(qtname)
+        configure['compare_merged'].add(qtname)
+        CHECKPOINT.done(qtname, configure['compare_result'][qtname], configure['compare_info'].get(qtname))
+    notify(qtname)
 
-def start_compare(sc, dc, q):
+
+def notify(qtname):
+    # 一个集合的数据对比完成，调用Comparator.run传入的回调
+    comparator = current()
+    if comparator.callback is not None:
+        comparator.callback(comparator, qtname, configure['compare_info'].get(qtname))
+
+
+def start_compare(sc, dc):
     '''
     对比数据
     :param sc: 源端连接实例
     :param dc: 目标端连接实例
-    :param q: 队列
     :return:
     '''
 
@@ -461,18 +2668,10 @@ def start_compare(sc, dc, q):
 
     # multi threads
     if configure[THREADS] > 1:
-        while True:
-            if q.empty(): break
+        SCHEDULER.run(callback=job_done)
         for i in configure['compare_result']:
-            if i in configure['compare_info']:
-                com_info = configure['compare_info'].get(i)
-                tmp = configure['compare_result'][i].replace('====', '====' if com_info[0] else 'XXX')
-                add_info = "Data comparison results: {}/{}, Percentage of inspection:{}%, Time consuming:{}s".format(com_info[2], com_info[1],
-                                                                                                                     round(
-                                                                                                                         (com_info[2] / com_info[1] if com_info[
-                                                                                                                                                           1] != 0 else 1) * 100,
-                                                                                                                         3), com_info[3])
-                configure['compare_result'][i] = tmp + ",datacompare={} ({})".format('ok' if com_info[0] else 'err', add_info)
+            if i in configure['compare_info'] and i not in configure['compare_merged']:
+                configure['compare_result'][i] = merged_result(i)
 
     log_info('summary info\n----------------------------------------')
     for i in configure['compare_result']:
@@ -484,16 +2683,92 @@ def start_compare(sc, dc, q):
         print(i)
 
 
+class Comparator(object):
+    '''
+    一对源端和目标端集群的数据对比，持有自己的配置、连接、对比结果、统计和断点文件，可以反复运行
+    模块中的函数通过configure、METRICS等代理访问当前的Comparator，同一进程中多个Comparator可以在各自的线程里并发运行，
+    并共用一个Scheduler；进程池、范围对比线程池和元数据预取线程池是进程内共用的，见create_pools()
+    '''
+
+    def __init__(self, src_url='', dst_url='', options=None, scheduler=None):
+        '''
+        :param src_url: 源端连接串
+        :param dst_url: 目标端连接串
+        :param options: 覆盖默认值的配置，key同configure，如 {COMPARISION_MODE: 'all', THREADS: 4}
+        :param scheduler: 共用的Scheduler，不指定时--threads大于1才在运行期间创建自己的
+        :raise ValueError: 配置不合法
+        '''
+        self.configure = normalize_options(dict(default_options(), **(options or {})))
+        self.src, self.dst = MongoCluster(src_url, 'src'), MongoCluster(dst_url, 'dst')
+        self.shared_scheduler = scheduler
+        self.callback = None
+        self.reset()
+
+    def reset(self):
+        # 清空上一次运行的对比结果和统计
+        self.configure['compare_result'], self.configure['compare_info'], self.configure['compare_merged'] = {}, {}, set()
+        self.meta_cache, self.projections = {}, {}
+        self.metrics, self.diff_log = Metrics(), DiffLog()
+        self.scheduler, self.checkpoint = self.shared_scheduler, None
+        self.ops_bucket = TokenBucket(self.configure[MAX_OPS]) if self.configure[MAX_OPS] > 0 else None
+        self.bytes_bucket = TokenBucket(self.configure[MAX_BYTES]) if self.configure[MAX_BYTES] > 0 else None
+
+    def run(self, callback=None):
+        '''
+        执行一次完整的对比，阻塞到结束(--follow时到跟踪结束)
+        :param callback: 每个集合的数据对比完成后调用 callback(comparator, qtname, compare_info)，
+                         在调用run的线程中执行，多个Comparator并发运行时回调也是并发的
+        :return: dict namespace -> 汇总行，同命令行输出的summary
+        '''
+        token = COMPARATOR.set(self)
+        follower = None
+        try:
+            self.reset()
+            self.callback = callback
+            create_pools(self.configure[PROCESSES], self.configure[RANGE_THREADS])
+            if self.scheduler is None and self.configure[THREADS] > 1:
+                self.scheduler = Scheduler(self.configure[THREADS])
+            if self.configure[CHECKPOINT_FILE]:
+                self.checkpoint = Checkpoint(self.configure[CHECKPOINT_FILE], self.configure[RESUME])
+            if self.configure[DIFF_FILE]:
+                self.diff_log.open(self.configure[DIFF_FILE])
+            sc, dc = self.src.connect(), self.dst.connect()
+            if self.configure[REPORT_INTERVAL] > 0 and (self.configure[REPORT_JSON] or self.configure[REPORT_PROM]):
+                self.metrics.start(self.configure[REPORT_INTERVAL])
+
+            if self.configure[FOLLOW]:
+                follower = Follower(sc, dc)
+                follower.start()
+
+            start_compare(sc, dc)
+
+            if follower is not None:
+                follower.run()
+        finally:
+            if follower is not None:
+                follower.close()
+            self.metrics.stop.set()
+            self.metrics.export()
+            self.diff_log.close()
+            if self.scheduler is not None and self.scheduler is not self.shared_scheduler:
+                self.scheduler.shutdown()
+            self.src.close()
+            self.dst.close()
+            COMPARATOR.reset(token)
+        return self.configure['compare_result']
+
+
+# 没有在Comparator.run中执行时(如直接调用模块中的函数)用的默认实例
+DEFAULT = Comparator()
+
+
 if __name__ == "__main__":
-    srcUrl, dstUrl = parse_args()
-    q = queue.Queue(configure[THREADS])
-    src, dst = MongoCluster(srcUrl), MongoCluster(dstUrl)
+    srcUrl, dstUrl, options = parse_args()
+    # 进程池在创建任何线程之前fork
+    create_pools(options[PROCESSES], options[RANGE_THREADS])
     print("[src = %s]" % srcUrl)
     print("[dst = %s]" % dstUrl)
-    sc = src.connect()
-    dc = dst.connect()
-
-    start_compare(sc, dc, q)
-
-    src.close()
-    dst.close()
+    try:
+        Comparator(srcUrl, dstUrl, options).run()
+    finally:
+        shutdown_pools()
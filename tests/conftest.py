@@ -0,0 +1,30 @@
+# -*- coding:utf-8 -*-
+import pytest
+
+
+def no_command(self, *args, **kwargs):
+    # mongomock不支持collstats，元数据退回estimated_document_count
+    from mongomock_pair import compare
+    raise compare.pymongo.errors.OperationFailure('collstats not supported')
+
+
+@pytest.fixture(autouse=True)
+def mongomock_commands(monkeypatch):
+    # 没有安装mongomock时在这里跳过测试
+    from mongomock_pair import mongomock
+    monkeypatch.setattr(mongomock.database.Database, 'command', no_command)
+
+
+@pytest.fixture
+def comparator():
+    # 在新的Comparator中执行，options为覆盖默认值的配置
+    from mongomock_pair import compare
+    tokens = []
+
+    def enter(**options):
+        instance = compare.Comparator(options=dict((getattr(compare, k), v) for k, v in options.items()))
+        tokens.append(compare.COMPARATOR.set(instance))
+        return instance
+    yield enter
+    for token in reversed(tokens):
+        compare.COMPARATOR.reset(token)
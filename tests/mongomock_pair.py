@@ -0,0 +1,19 @@
+# -*- coding:utf-8 -*-
+# 测试共用的模块和mongomock集合，测试模块和conftest都从这里导入
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compare_mongodb_data as compare  # noqa: E402
+
+
+def make_pair(docs, version=42):
+    # 源端和目标端各一个内容相同的mongomock集合
+    src, dst = mongomock.MongoClient().db.x, mongomock.MongoClient().db.x
+    for coll in (src, dst):
+        coll.insert_many([dict(doc) for doc in docs])
+        compare.SERVER_VERSION[coll.database.client] = version
+    return src, dst
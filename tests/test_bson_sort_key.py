@@ -0,0 +1,58 @@
+# -*- coding:utf-8 -*-
+import datetime
+import random
+import re
+import uuid
+
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from bson.timestamp import Timestamp
+
+from mongomock_pair import compare
+
+# 按mongodb服务端的排序规则从小到大排好的_id，归并对比依赖bson_sort_key给出同样的顺序
+SERVER_ORDER = [
+    MinKey(),
+    None,
+    float('nan'),
+    -5,
+    Decimal128('1.5'),
+    2,
+    2.5,
+    'a',
+    'b',
+    # 文档逐个字段比较，先比值的类型，再比字段名，最后比值
+    {'a': 1},
+    {'b': 0},
+    {'a': 'x'},
+    [1, 2],
+    Binary(b'\x01', 0),
+    Binary(b'\x00\x00', 0),
+    Binary(b'\x00\x00', 5),
+    Binary(b'\x00' * 16, 3),
+    uuid.UUID(int=1),
+    uuid.UUID(int=2),
+    Binary(uuid.UUID(int=3).bytes, 4),
+    Binary(b'\x00' * 16, 5),
+    ObjectId('000000000000000000000001'),
+    ObjectId('000000000000000000000002'),
+    False,
+    True,
+    datetime.datetime(2020, 1, 1),
+    datetime.datetime(2021, 1, 1),
+    Timestamp(1, 1),
+    Timestamp(1, 2),
+    Regex('a'),
+    re.compile('b'),
+    MaxKey(),
+]
+
+
+def test_bson_sort_key_matches_server_order():
+    values = list(SERVER_ORDER)
+    random.Random(0).shuffle(values)
+    assert [repr(value) for value in sorted(values, key=compare.bson_sort_key)] == [repr(value) for value in SERVER_ORDER]
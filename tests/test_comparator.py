@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+import pytest
+
+from mongomock_pair import compare, make_pair, mongomock
+
+
+def test_pools_are_recreated_after_shutdown(comparator):
+    # 关闭共用的线程池后，同一进程中再运行Comparator要重新创建线程池，而不是提交到已经关闭的线程池
+    comparator(RANGE_THREADS=2)
+    src, _ = make_pair([{'_id': i} for i in range(10)])
+    compare.create_pools(0, 2)
+    compare.prefetch_meta([src])[0].result()
+    compare.shutdown_pools()
+    assert compare.RANGE_POOL is None and compare.META_POOL is None
+    compare.create_pools(0, 2)
+    assert compare.range_pool().submit(len, 'abc').result() == 3
+    assert compare.prefetch_meta([src.database.y])[0].result().count == 0
+    compare.shutdown_pools()
+
+
+def test_follow_thread_stops_when_initial_comparison_fails(comparator, monkeypatch):
+    # 初始对比出错时也要停下跟踪线程，不能在关闭的连接上一直重试
+    def connect(self):
+        self.conn = mongomock.MongoClient()
+        compare.SERVER_VERSION[self.conn] = 36
+        return self.conn
+
+    def fail(sc, dc):
+        raise KeyboardInterrupt()
+    followers = []
+    start = compare.Follower.start
+
+    def record(self):
+        followers.append(self)
+        start(self)
+    monkeypatch.setattr(compare.MongoCluster, 'connect', connect)
+    monkeypatch.setattr(compare.Follower, 'start', record)
+    monkeypatch.setattr(compare.Follower, 'tail', lambda self: self.stop.wait())
+    monkeypatch.setattr(compare, 'start_compare', fail)
+    with pytest.raises(KeyboardInterrupt):
+        compare.Comparator(options={compare.FOLLOW: True}).run()
+    assert followers and not followers[0].thread.is_alive()
@@ -0,0 +1,134 @@
+# -*- coding:utf-8 -*-
+import bisect
+
+import pytest
+
+from mongomock_pair import compare, make_pair
+
+
+@pytest.fixture
+def buckets(monkeypatch):
+    # mongomock没有$toHashedIndexKey，在客户端按桶求摘要并记录两端各扫描了多少行；游标不支持min/max，叶子桶也在客户端对比
+    scanned, merged = {}, []
+
+    def digests(coll, kind, lower, upper, points):
+        docs = list(coll.find(compare.range_filter(lower, upper)).sort('_id', 1))
+        scanned[id(coll.database.client)] = scanned.get(id(coll.database.client), 0) + len(docs)
+        keys = [compare.bson_sort_key(point) for point in points]
+        result = [[] for _ in range(len(points) + 1)]
+        for doc in docs:
+            result[bisect.bisect_right(keys, compare.bson_sort_key(doc['_id']))].append(doc)
+        return [{'n': len(bucket), 'h': repr(bucket)} if bucket else {'n': 0} for bucket in result]
+
+    def leaf(srcColl, dstColl, qtname, lower=None, upper=None):
+        merged.append((lower, upper))
+        src_docs, dst_docs = digests(srcColl, None, lower, upper, []), digests(dstColl, None, lower, upper, [])
+        return {'checked': src_docs[0]['n'], 'diff': int(src_docs != dst_docs)}
+    monkeypatch.setattr(compare, 'digest_kind', lambda coll: 'hashed')
+    monkeypatch.setattr(compare, 'bucket_digests', digests)
+    monkeypatch.setattr(compare, 'merge_join_comparison', leaf)
+    return scanned, merged
+
+
+def test_scattered_mismatches_scan_each_side_once(comparator, buckets):
+    # 每个桶都有一个不一致时，两端也只各扫描一遍集合求摘要，再逐条对比这些桶
+    comparator(HASH_LEAF_SIZE=100, HASH_FANOUT=4)
+    src, dst = make_pair([{'_id': i, 'v': 0} for i in range(2000)])
+    dst.update_many({'_id': {'$in': list(range(50, 2000, 100))}}, {'$set': {'v': 1}})
+    stat = compare.hash_comparison(src, dst, 'db.x', 2000, 0)
+    scanned, merged = buckets
+    assert stat['diff'] == 20
+    assert stat['ranges_hashed'] == 20 and stat['leaf_ranges'] == 20
+    # 摘要各扫描一遍，逐条对比的桶又各读一遍
+    assert scanned == {id(src.database.client): 4000, id(dst.database.client): 4000}
+
+
+def test_hash_buckets_with_zero_leaf_size(comparator, buckets):
+    # --hash-leaf-size=0按1处理，每行一个桶
+    comparator(HASH_LEAF_SIZE=0)
+    src, dst = make_pair([{'_id': i, 'v': 0} for i in range(20)])
+    dst.update_one({'_id': 7}, {'$set': {'v': 1}})
+    stat = compare.hash_comparison(src, dst, 'db.x', 20, 0)
+    assert stat['diff'] == 1
+    assert buckets[1] == [(7, 8)]
+
+
+def evaluate(expr, scope):
+    # 在客户端求值digest_value和digest_deep用到的聚合表达式
+    if isinstance(expr, list):
+        return [evaluate(e, scope) for e in expr]
+    if isinstance(expr, str):
+        if not expr.startswith('$$'):
+            return expr
+        name, _, field = expr[2:].partition('.')
+        return scope[name][field] if field else scope[name]
+    if not isinstance(expr, dict):
+        return expr
+    (op, arg), = expr.items()
+    if op == '$let':
+        inner = dict(scope, **dict((k, evaluate(v, scope)) for k, v in arg['vars'].items()))
+        return evaluate(arg['in'], inner)
+    if op == '$switch':
+        for branch in arg['branches']:
+            if evaluate(branch['case'], scope):
+                return evaluate(branch['then'], scope)
+        return evaluate(arg['default'], scope)
+    if op == '$cond':
+        return evaluate(arg[1] if evaluate(arg[0], scope) else arg[2], scope)
+    if op == '$map':
+        return [evaluate(arg['in'], dict(scope, **{arg['as']: item})) for item in evaluate(arg['input'], scope)]
+    if op == '$type':
+        value = evaluate(arg, scope)
+        return {float: 'double', dict: 'object', list: 'array', str: 'string', int: 'int'}[type(value)]
+    if op == '$in':
+        return evaluate(arg[0], scope) in evaluate(arg[1], scope)
+    if op == '$eq':
+        return evaluate(arg[0], scope) == evaluate(arg[1], scope)
+    if op == '$toString':
+        return repr(evaluate(arg, scope))
+    if op == '$objectToArray':
+        return [{'k': k, 'v': v} for k, v in evaluate(arg, scope).items()]
+    if op == '$max':
+        values = [v for v in evaluate(arg, scope) if v is not None]
+        return max(values) if values else None
+    raise NotImplementedError(op)
+
+
+def hashed_index_key(value):
+    # 和$toHashedIndexKey一样，求hash前把小数截成整数
+    if isinstance(value, float):
+        return int(value)
+    if isinstance(value, dict):
+        return tuple((k, hashed_index_key(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(hashed_index_key(v) for v in value)
+    return value
+
+
+def test_digest_keeps_fractional_part():
+    # 只有小数部分不同的文档，直接对$$ROOT求hash时相同，展开后的摘要要不同
+    src = {'_id': 1, 'price': 9.99, 'items': [{'w': 2.3}]}
+    for dst in ({'_id': 1, 'price': 9.5, 'items': [{'w': 2.3}]}, {'_id': 1, 'price': 9.99, 'items': [{'w': 2.9}]}):
+        assert hashed_index_key(src) == hashed_index_key(dst)
+        digests = [hashed_index_key(evaluate(compare.digest_value('$$ROOT', compare.DIGEST_DEPTH), {'ROOT': doc})) for doc in (src, dst)]
+        assert digests[0] != digests[1]
+    # 类型不同的值展开后也不同
+    assert evaluate(compare.digest_value('$$ROOT', 2), {'ROOT': {'a': [1]}}) != evaluate(compare.digest_value('$$ROOT', 2), {'ROOT': {'a': {'0': 1}}})
+
+
+def test_digest_flags_documents_nested_too_deep():
+    # 超过DIGEST_DEPTH层的部分没有展开，摘要不能证明一致
+    shallow, deep = {'a': {'b': 1.5}}, {'a': {'b': {'c': {'d': {'e': 1.5}}}}}
+    assert evaluate(compare.digest_deep('$$ROOT', compare.DIGEST_DEPTH), {'ROOT': shallow}) == 0
+    assert evaluate(compare.digest_deep('$$ROOT', compare.DIGEST_DEPTH), {'ROOT': deep}) == 1
+
+
+def test_equal_digest_with_deep_documents_is_compared(comparator, buckets, monkeypatch):
+    # 桶里有嵌套过深的文档时，摘要相同也要逐条对比
+    comparator(HASH_LEAF_SIZE=100)
+    src, dst = make_pair([{'_id': i, 'v': {'a': {'b': {'c': {'d': 0.5}}}}} for i in range(20)])
+    dst.update_one({'_id': 7}, {'$set': {'v.a.b.c.d': 0.7}})
+    monkeypatch.setattr(compare, 'bucket_digests', lambda coll, kind, lower, upper, points: [{'n': 20, 'h': 0, 'deep': 20}])
+    stat = compare.hash_comparison(src, dst, 'db.x', 20, 0)
+    assert buckets[1] == [(None, None)]
+    assert stat['diff'] == 1
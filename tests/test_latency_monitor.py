@@ -0,0 +1,28 @@
+# -*- coding:utf-8 -*-
+from types import SimpleNamespace
+
+from mongomock_pair import compare
+
+
+def find(monitor, request_id, coll, micros, docs):
+    # 模拟一次返回docs行文档、耗时micros微秒的find命令
+    command = {'find': coll, 'filter': {}}
+    monitor.started(SimpleNamespace(command_name='find', command=command, database_name='db', request_id=request_id))
+    reply = {'cursor': {'id': 0, 'firstBatch': [{}] * docs}}
+    monitor.succeeded(SimpleNamespace(command_name='find', command=command, request_id=request_id,
+                                      duration_micros=micros, reply=reply))
+
+
+def test_backoff_baseline_is_per_namespace(comparator):
+    # 小文档的集合之后对比大文档的集合，每行耗时变高是文档大小造成的，不能当成源端负载升高而退避
+    comparator()
+    monitor = compare.LatencyMonitor('src')
+    for i in range(50):
+        find(monitor, i, 'small', 1000, 100)
+    for i in range(50, 100):
+        find(monitor, i, 'large', 50000, 100)
+    assert monitor.backoff('db.large', 1.0) == 0
+    assert monitor.backoff('db.small', 1.0) == 0
+    for i in range(100, 110):
+        find(monitor, i, 'small', 50000, 100)
+    assert monitor.backoff('db.small', 1.0) > 0
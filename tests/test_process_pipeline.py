@@ -0,0 +1,32 @@
+# -*- coding:utf-8 -*-
+from mongomock_pair import compare, make_pair
+
+
+def test_sample_batches_fill_process_pool(comparator, monkeypatch):
+    # --processes=8时取样的各批不等结果，最多2*8批同时交给进程池，全部批最后都取回结果
+    comparator(PROCESSES=8, COMPARISION_COUNT=1000, BATCH_SIZE=20, BATCH_MIN=20, BATCH_MAX=20)
+    src, dst = make_pair([{'_id': i, 'v': 0} for i in range(2000)])
+    tasks = []
+
+    class Task(object):
+        # 代替RawTask，结果只有在get()时才完成
+        def __init__(self, src_docs, dst_docs):
+            self.n, self.done = len(src_docs), False
+            tasks.append(self)
+            Task.peak = max(getattr(Task, 'peak', 0), sum(1 for task in tasks if not task.done))
+
+        def ready(self):
+            return False
+
+        def get(self):
+            self.done = True
+            return {'checked': self.n, 'src_only': [], 'dst_only': [], 'diff': []}
+    monkeypatch.setattr(compare, 'RawTask', Task)
+    monkeypatch.setattr(compare, 'process_pool', lambda: object())
+    # mongomock不支持RawBSONDocument
+    monkeypatch.setattr(compare, 'doc_coll', lambda coll: coll)
+    status, checked, _ = compare.data_comparison(src, dst, 'sample', full_check_size=0, qtname='db.x')
+    assert status
+    assert checked == 1000
+    assert Task.peak == 2 * 8 + 1
+    assert all(task.done for task in tasks)
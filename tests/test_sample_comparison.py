@@ -0,0 +1,113 @@
+# -*- coding:utf-8 -*-
+import contextvars
+import datetime
+from threading import Thread
+
+import pytest
+from bson.objectid import ObjectId
+
+from mongomock_pair import compare, make_pair
+
+
+@pytest.mark.parametrize('docs', [500, 3000])
+def test_small_confidence_sample_on_legacy_source(comparator, docs):
+    # 按置信度算出的样本数小于一批，低版本源端走skip取样，不能死循环或除零
+    comparator(CONFIDENCE=0.9, MISMATCH_RATE=0.3, SS=40)
+    src, dst = make_pair([{'_id': 'id%06d' % i, 'v': i} for i in range(docs)], version=36)
+    result = []
+
+    def run():
+        result.append(compare.data_comparison(src, dst, 'sample', qtname='db.x'))
+    thread = Thread(target=contextvars.copy_context().run, args=(run,))
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), 'sample comparison did not finish'
+    status, checked, _ = result[0]
+    assert status
+    assert checked >= compare.sample_size(docs, 0.9, 0.3)
+
+
+def test_recheck_does_not_pass_sampling_stopped_at_limit(comparator, monkeypatch):
+    # 达到--max-mismatches提前结束的对比，复查时那一个不一致消失了，也不能报告一致，剩下的文档没有对比过
+    comparator(MAX_MISMATCHES=1, RECHECK_DELAY=5, BATCH_SIZE=30, BATCH_MIN=30)
+    src, dst = make_pair([{'_id': i, 'v': 0} for i in range(2000)])
+    dst.update_many({'_id': {'$lt': 50}}, {'$set': {'v': 1}})
+    # 最新的一条是同步延迟造成的，复查前同步完成
+    dst.update_one({'_id': 1999}, {'$set': {'v': 1}})
+    monkeypatch.setattr(compare.time, 'sleep', lambda seconds: dst.update_one({'_id': 1999}, {'$set': {'v': 0}}))
+    status, checked, _ = compare.data_comparison(src, dst, 'sample', check_latest_size=30, qtname='db.x')
+    assert not status
+    assert checked < 2000
+    assert compare.configure['compare_info']['db.x'][4]['transient'] == 1
+
+
+@pytest.mark.parametrize('diffs', [1, 2])
+def test_sample_counts_each_mismatch_once(comparator, monkeypatch, diffs):
+    # $sample每批独立取样，同一个不一致的文档被取到多次也只算一次；这里每批$sample都返回最前面的文档
+    def first_docs(self, pipeline, *args, **kwargs):
+        return iter(self.find().sort('_id', 1).limit(pipeline[0]['$sample']['size']))
+    comparator(COMPARISION_COUNT=40, BATCH_SIZE=10, BATCH_MIN=10, BATCH_MAX=10)
+    src, dst = make_pair([{'_id': i, 'v': 0} for i in range(40)])
+    monkeypatch.setattr(type(src), 'aggregate', first_docs)
+    dst.update_many({'_id': {'$lt': diffs}}, {'$set': {'v': 1}})
+    status, _, _ = compare.data_comparison(src, dst, 'sample', full_check_size=0, qtname='db.x')
+    assert not status
+    assert compare.configure['compare_info']['db.x'][4] == {'src_only': 0, 'diff': diffs}
+
+
+def test_seek_sample_on_bursty_object_ids(comparator, monkeypatch):
+    # 少量早期文档加上一大批最近写入的ObjectId，插值的_id大多落在时间空档里，
+    # 取样要换成按_id范围插值或skip取样，检查行数按实际对比的文档数计算
+    comparator(COMPARISION_COUNT=200, SS=40)
+    old = [ObjectId.from_datetime(datetime.datetime(2015, 1, 1) + datetime.timedelta(days=i)) for i in range(10)]
+    recent = [ObjectId() for _ in range(1990)]
+    src, dst = make_pair([{'_id': _id, 'v': 0} for _id in old + recent], version=36)
+
+    def split_vector(self, name, *args, **kwargs):
+        # mongomock没有splitVector，每100行一个切分点
+        ids = sorted(old + recent)
+        return {'splitKeys': [{'_id': ids[i]} for i in range(100, len(ids), 100)]}
+    monkeypatch.setattr(type(src.database), 'command', split_vector)
+    compared = set()
+    compare_batch = compare.compare_batch
+
+    def record(docs, dstColl, qtname):
+        compared.update(doc['_id'] for doc in docs)
+        return compare_batch(docs, dstColl, qtname)
+    monkeypatch.setattr(compare, 'compare_batch', record)
+    status, checked, _ = compare.data_comparison(src, dst, 'sample', full_check_size=0, qtname='db.x')
+    assert status
+    assert len(compared) >= 100
+    assert checked <= 2 * len(compared)
+
+
+def test_recheck_keeps_mismatches_restored_from_checkpoint(comparator, monkeypatch):
+    # --resume恢复的不一致只有个数，复查时新发现的那一个是暂时不一致，也不能把结果改成一致
+    comparator(RECHECK_DELAY=5)
+    src, dst = make_pair([{'_id': i, 'v': 0} for i in range(10)])
+    monkeypatch.setattr(compare.time, 'sleep', lambda seconds: None)
+    compare.DIFF_LOG.add('db.x', 'diff', 3)
+    compare.configure['compare_info']['db.x'] = (False, 10, 10, 0, {'src_only': 0, 'dst_only': 0, 'diff': 2})
+    status, _, _ = compare.recheck_mismatches(src, dst, 'db.x', (False, 10, 0))
+    assert not status
+    assert compare.configure['compare_info']['db.x'][4]['transient'] == 1
+
+
+def test_skip_sample_counts_distinct_docs(comparator, monkeypatch):
+    # 字符串_id不能插值，低版本退回skip取样；样本不足时也不能从头再扫描一遍，把重复对比的文档算进检查行数和置信上界
+    comparator(CONFIDENCE=0.99, MISMATCH_RATE=0.01, SS=40)
+    src, dst = make_pair([{'_id': 'id%06d' % i, 'v': 0} for i in range(3000)], version=36)
+    compared = []
+    compare_batch = compare.compare_batch
+
+    def record(docs, dstColl, qtname):
+        compared.extend(doc['_id'] for doc in docs)
+        return compare_batch(docs, dstColl, qtname)
+    monkeypatch.setattr(compare, 'compare_batch', record)
+    status, checked, _ = compare.data_comparison(src, dst, 'sample', full_check_size=0, qtname='db.x')
+    assert status
+    assert len(compared) == len(set(compared))
+    assert checked == len(compared)
+    bound = compare.mismatch_bound(checked, 3000, 0.99) * 100
+    assert compare.configure['compare_info']['db.x'][4]['mismatch_rate<='] == '%.4f%%' % bound